@@ -0,0 +1,68 @@
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+RUNS = 5
+
+# Код, выполняемый в отдельном интерпретаторе: импорт bot.py и обработка первого /start
+PROBE = r"""
+import asyncio
+import time
+
+started = time.perf_counter()
+import bot
+imported = time.perf_counter()
+
+class Message:
+    async def reply_text(self, text, reply_markup=None):
+        pass
+
+class User:
+    id = 1
+    username = "bench"
+    first_name = "Bench"
+    last_name = None
+
+class FakeUpdate:
+    effective_user = User()
+    message = Message()
+
+class FakeContext:
+    args = []
+
+asyncio.run(bot.start(FakeUpdate(), FakeContext()))
+handled = time.perf_counter()
+print(imported - started, handled - started)
+"""
+
+def measure_once():
+    # Отдельная временная папка, чтобы не трогать рабочую warp_bot.db
+    with tempfile.TemporaryDirectory() as workdir:
+        env = dict(os.environ, PYTHONPATH=REPO_DIR, PYTHONDONTWRITEBYTECODE="1")
+        result = subprocess.run(
+            [sys.executable, "-c", PROBE],
+            cwd=workdir,
+            env=env,
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+    import_time, first_update = result.stdout.split()
+    return float(import_time), float(first_update)
+
+def run_benchmark(runs=RUNS):
+    samples = [measure_once() for _ in range(runs)]
+    import_times = [sample[0] * 1000 for sample in samples]
+    first_updates = [sample[1] * 1000 for sample in samples]
+
+    print(f"Запусков: {runs}")
+    print(f"Импорт bot.py: медиана {statistics.median(import_times):.1f} мс, "
+          f"мин. {min(import_times):.1f} мс")
+    print(f"Первое обновление (/start): медиана {statistics.median(first_updates):.1f} мс, "
+          f"мин. {min(first_updates):.1f} мс")
+
+if __name__ == "__main__":
+    run_benchmark(int(sys.argv[1]) if len(sys.argv) > 1 else RUNS)
@@ -1,45 +1,182 @@
+import time
+
+PROCESS_STARTED_AT = time.perf_counter()  # Для замера времени запуска
+
+import os
+import sys
+import copy
+import queue
+import atexit
 import sqlite3
 import logging
+import logging.handlers
 import uuid
-from datetime import datetime, timedelta
+import io
+import hashlib
+import functools
+import secrets
+import signal
+from collections import Counter, OrderedDict
+import json
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import BadRequest, Forbidden, RetryAfter
 from telegram.ext import (
     Application,
     CommandHandler,
     CallbackQueryHandler,
     ContextTypes,
+    ApplicationHandlerStop,
     MessageHandler,
+    TypeHandler,
     filters
 )
-from flask import Flask, render_template, request, redirect, url_for, flash, session
-from werkzeug.security import generate_password_hash, check_password_hash
 import threading
 import asyncio
+import settings
 
-# Настройка логирования
-logging.basicConfig(
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-    level=logging.INFO,
-)
+# Настройка логирования: записи уходят в очередь, а JSON-форматирование и вывод
+# выполняет отдельный поток QueueListener, не задерживая цикл событий
+LOG_LEVEL = logging.INFO
+LOG_WARNING_BURST = 5  # Сколько одинаковых предупреждений (из одного места кода) пропускать за окно
+LOG_WARNING_WINDOW = 60  # Длина окна ограничения предупреждений, секунд
+
+# Стандартные поля LogRecord; всё остальное считается структурными полями из extra
+LOG_RECORD_FIELDS = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime"}
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "ts": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in LOG_RECORD_FIELDS:
+                entry[key] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+class StructuredQueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        # В отличие от QueueHandler.prepare, не форматируем запись целиком, а сохраняем поля из extra
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+class RepeatedWarningFilter(logging.Filter):
+    # Пропускает не более burst предупреждений из одного места кода за окно, остальные считает
+    def __init__(self, burst, window):
+        super().__init__()
+        self.burst = burst
+        self.window = window
+        self.lock = threading.Lock()
+        self.windows = {}  # (logger, файл, строка) -> [начало окна, пропущено, подавлено]
+    
+    def filter(self, record):
+        if record.levelno != logging.WARNING:
+            return True
+        
+        key = (record.name, record.pathname, record.lineno)
+        now = time.monotonic()
+        with self.lock:
+            state = self.windows.get(key)
+            if state is None or now - state[0] >= self.window:
+                suppressed = state[2] if state else 0
+                state = self.windows[key] = [now, 0, 0]
+                if suppressed:
+                    record.suppressed = suppressed
+            if state[1] >= self.burst:
+                state[2] += 1
+                return False
+            state[1] += 1
+        return True
+
+def setup_logging():
+    log_queue = queue.SimpleQueue()
+    
+    stream_handler = logging.StreamHandler(sys.stderr)
+    stream_handler.setFormatter(JsonFormatter())
+    listener = logging.handlers.QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    
+    queue_handler = StructuredQueueHandler(log_queue)
+    queue_handler.addFilter(RepeatedWarningFilter(LOG_WARNING_BURST, LOG_WARNING_WINDOW))
+    
+    root = logging.getLogger()
+    root.handlers = [queue_handler]
+    root.setLevel(LOG_LEVEL)
+    # httpx пишет строку на каждый запрос к Telegram API
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+log_listener = setup_logging()
 logger = logging.getLogger(__name__)
 
-# Конфигурация
-BOT_TOKEN = "7935425343:AAECbjFJvLHkeTvwHAKDG8uvmy-KiWcPtns"
-ADMIN_TELEGRAM_ID = 650154766  # Ваш ID в Telegram
-DB_FILE = "warp_bot.db"
-WEB_SECRET_KEY = "your-secret-key"  # Секретный ключ для Flask
-ADMIN_USERNAME = "astracat"  # Имя пользователя для входа в веб-интерфейс
-ADMIN_PASSWORD_HASH = generate_password_hash("astracat")  # Пароль
-
-# Инициализация Flask и Telegram Application
-app = Flask(__name__)
-app.secret_key = WEB_SECRET_KEY
+# Конфигурация из settings.py (.env и переменные окружения)
+SETTINGS = settings.SETTINGS
+BOT_TOKEN = SETTINGS["BOT_TOKEN"]
+DB_FILE = SETTINGS["DB_FILE"]
+WEB_PORT = SETTINGS["PORT"]
+# Секретный ключ для Flask; если не задан, генерируется при запуске (сессии не переживут перезапуск)
+WEB_SECRET_KEY = SETTINGS["WEB_SECRET_KEY"] or secrets.token_hex(32)
+
+# Эти значения перечитываются по SIGHUP или /reload без перезапуска (см. reload_settings)
+ADMIN_IDS = set(SETTINGS["ADMIN_IDS"])  # ID администраторов в Telegram
+ADMIN_USERNAME = SETTINGS["ADMIN_USERNAME"]  # Имя пользователя для входа в веб-интерфейс
+ADMIN_PASSWORD = SETTINGS["ADMIN_PASSWORD"]  # Пароль (используется, если не задан ADMIN_PASSWORD_HASH)
+ADMIN_PASSWORD_HASH = SETTINGS["ADMIN_PASSWORD_HASH"]  # Готовый хэш пароля, избавляет от хэширования при запуске
+CONFIG_COOLDOWN_HOURS = SETTINGS["CONFIG_COOLDOWN_HOURS"]  # Как часто можно получать конфигурацию, часов
+XRAY_DAILY_LIMIT = SETTINGS["XRAY_DAILY_LIMIT"]  # Бесплатных запросов Xray VPN Veless в день
+REFERRAL_BONUS = SETTINGS["REFERRAL_BONUS"]  # Дополнительных запросов Xray за активированный реферальный код
+
+QR_RENDER_WORKERS = 2  # Потоки для отрисовки QR-кодов
+JOB_WORKERS = 2  # Корутины-обработчики очереди задач
+JOB_MAX_ATTEMPTS = 5  # Попыток на задачу до пометки failed
+JOB_RETRY_BASE_DELAY = 5  # Базовая задержка повтора, секунд (растёт экспоненциально)
+JOB_VISIBILITY_TIMEOUT = 60  # Через сколько секунд "зависшая" задача снова доступна воркерам
+JOB_POLL_INTERVAL = 2  # Интервал опроса очереди, секунд
+JOB_SEND_DELAY = 0.1  # Пауза после отправки, чтобы не превысить лимиты Telegram
+JOB_PRIORITY_DEFAULT = 0  # Приоритет задач: меньше — раньше (уведомления, отчёты)
+JOB_PRIORITY_BROADCAST = 10  # Сообщения рассылки не задерживают остальные уведомления
+BROADCAST_REPORT_INTERVAL = 10  # Как часто обновлять сообщение о ходе рассылки, секунд
+CONCURRENT_UPDATES = 16  # Сколько обновлений обрабатывается одновременно
+SEEN_UPDATES_TTL = 24 * 3600  # Сколько помнить обработанные update_id/callback_id, секунд
+SEEN_UPDATES_MEMORY_SIZE = 10000  # Размер кэша обработанных id в памяти
+XRAY_QUOTA_MEMORY_SIZE = 10000  # Сколько балансов квоты Xray держать в памяти
+SEEN_UPDATES_PRUNE_EVERY = 1000  # Раз в сколько записей чистить устаревшие id в базе
+TELEGRAM_HEALTH_INTERVAL = 60  # Период фоновой проверки связи с Telegram API, секунд
+DASHBOARD_STREAM_INTERVAL = 2  # Как часто поток SSE проверяет изменения статистики, секунд
+DASHBOARD_STREAM_HEARTBEAT = 15  # Период пустых сообщений SSE, чтобы прокси не рвали соединение
+JOB_SHUTDOWN_TIMEOUT = 10  # Сколько ждать завершения текущих задач при остановке, секунд
+WEB_SHUTDOWN_TIMEOUT = 10  # Сколько ждать завершения запросов к веб-интерфейсу при остановке, секунд
+
+# Глобальные объекты Flask и Telegram Application (создаются в main)
+app = None
 application = None  # Глобальная переменная для Telegram Application
+web_server = None
+web_thread = None
+shutdown_event = threading.Event()  # Сигнал длинным запросам веб-интерфейса (SSE) завершиться
 
 # Класс базы данных
 class Database:
-    def __init__(self):
-        self.conn = sqlite3.connect(DB_FILE, check_same_thread=False)
+    def __init__(self, db_file=DB_FILE):
+        self.conn = sqlite3.connect(db_file, check_same_thread=False)
+        # Соединение общее для бота и Flask: операции очереди должны быть атомарными
+        self.lock = threading.RLock()
+        # Растёт при каждом изменении пользователей и конфигураций; по нему кэшируется статистика
+        self.data_version = 0
         self.create_tables()
     
     def create_tables(self):
@@ -67,96 +204,578 @@ class Database:
         )
         ''')
         
-        self.conn.commit()
-    
-    def add_user(self, user):
-        cursor = self.conn.cursor()
-        cursor.execute(
-            "INSERT OR IGNORE INTO users (telegram_id, username, first_name, last_name, first_seen) "
-            "VALUES (?, ?, ?, ?, ?)",
-            (user.id, user.username, user.first_name, user.last_name, datetime.now())
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS jobs (
+            job_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            idempotency_key TEXT UNIQUE,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER DEFAULT 0,
+            run_at REAL NOT NULL,
+            locked_by TEXT,
+            locked_until REAL,
+            last_error TEXT,
+            created_at REAL NOT NULL,
+            updated_at REAL NOT NULL,
+            priority INTEGER NOT NULL DEFAULT 0,
+            batch_id TEXT
         )
-        self.conn.commit()
-    
-    def is_banned(self, user_id):
-        cursor = self.conn.cursor()
-        cursor.execute("SELECT is_banned FROM users WHERE telegram_id = ?", (user_id,))
-        result = cursor.fetchone()
-        return result and result[0] == 1
-    
-    def can_get_config(self, user_id):
-        cursor = self.conn.cursor()
-        cursor.execute("SELECT last_config_time FROM users WHERE telegram_id = ?", (user_id,))
-        result = cursor.fetchone()
+        ''')
         
-        if not result or not result[0]:
-            return True
-            
-        last_time = datetime.fromisoformat(result[0])
-        return datetime.now() - last_time >= timedelta(hours=24)
-    
-    def add_config(self, user_id):
-        cursor = self.conn.cursor()
-        config_id = str(uuid.uuid4())
+        # Базы, созданные до появления приоритетов и рассылочных пакетов
+        cursor.execute("PRAGMA table_info(jobs)")
+        job_columns = {row[1] for row in cursor.fetchall()}
+        if "priority" not in job_columns:
+            cursor.execute("ALTER TABLE jobs ADD COLUMN priority INTEGER NOT NULL DEFAULT 0")
+        if "batch_id" not in job_columns:
+            cursor.execute("ALTER TABLE jobs ADD COLUMN batch_id TEXT")
         
+        cursor.execute("DROP INDEX IF EXISTS idx_jobs_status_run_at")
+        cursor.execute(
+            "CREATE INDEX IF NOT EXISTS idx_jobs_status_priority_run_at ON jobs (status, priority, run_at)"
+        )
         cursor.execute(
-            "INSERT INTO configs (config_id, telegram_id, created_at) VALUES (?, ?, ?)",
-            (config_id, user_id, datetime.now())
+            "CREATE INDEX IF NOT EXISTS idx_jobs_batch_status ON jobs (batch_id, status)"
         )
         
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS seen_updates (
+            update_key TEXT PRIMARY KEY,
+            seen_at REAL NOT NULL
+        )
+        ''')
+        
+        # Для периодической очистки устаревших записей в prune_seen_updates
         cursor.execute(
-            "UPDATE users SET last_config_time = ? WHERE telegram_id = ?",
-            (datetime.now().isoformat(), user_id)
+            "CREATE INDEX IF NOT EXISTS idx_seen_updates_seen_at ON seen_updates (seen_at)"
         )
         
-        self.conn.commit()
-        return config_id
-    
-    def get_stats(self):
-        cursor = self.conn.cursor()
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS referral_codes (
+            code TEXT PRIMARY KEY,
+            telegram_id INTEGER UNIQUE NOT NULL,
+            created_at DATETIME
+        )
+        ''')
         
-        cursor.execute("SELECT COUNT(*) FROM users WHERE is_banned = 0")
-        active_users = cursor.fetchone()[0]
+        # Первичный ключ по приглашённому гарантирует, что код активируется не более одного раза
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS referral_redemptions (
+            referred_id INTEGER PRIMARY KEY,
+            referrer_id INTEGER NOT NULL,
+            code TEXT NOT NULL,
+            redeemed_at DATETIME
+        )
+        ''')
         
-        cursor.execute("SELECT COUNT(*) FROM users WHERE is_banned = 1")
-        banned_users = cursor.fetchone()[0]
+        # Журнал квоты Xray только дополняется: kind = 'daily' (дневной лимит) или 'bonus' (рефералы)
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS xray_quota_ledger (
+            entry_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            telegram_id INTEGER NOT NULL,
+            kind TEXT NOT NULL,
+            delta INTEGER NOT NULL,
+            day TEXT,
+            reason TEXT,
+            created_at DATETIME
+        )
+        ''')
         
-        cursor.execute("SELECT COUNT(*) FROM configs WHERE is_active = 1")
-        active_configs = cursor.fetchone()[0]
+        cursor.execute(
+            "CREATE INDEX IF NOT EXISTS idx_xray_quota_user_kind_day ON xray_quota_ledger (telegram_id, kind, day)"
+        )
         
-        cursor.execute("SELECT COUNT(*) FROM configs")
-        total_configs = cursor.fetchone()[0]
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS qr_cache (
+            payload_hash TEXT PRIMARY KEY,
+            file_id TEXT,
+            created_at DATETIME
+        )
+        ''')
         
-        return active_users, banned_users, active_configs, total_configs
+        self.conn.commit()
+    
+    def add_user(self, user):
+        with self.lock:
+            cursor = self.conn.cursor()
+            cursor.execute(
+                "INSERT OR IGNORE INTO users (telegram_id, username, first_name, last_name, first_seen) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (user.id, user.username, user.first_name, user.last_name, datetime.now())
+            )
+            self.conn.commit()
+            if cursor.rowcount:
+                self.data_version += 1
+    
+    def is_banned(self, user_id):
+        with self.lock:
+            cursor = self.conn.cursor()
+            cursor.execute("SELECT is_banned FROM users WHERE telegram_id = ?", (user_id,))
+            result = cursor.fetchone()
+            return result and result[0] == 1
+    
+    def can_get_config(self, user_id):
+        with self.lock:
+            cursor = self.conn.cursor()
+            cursor.execute("SELECT last_config_time FROM users WHERE telegram_id = ?", (user_id,))
+            result = cursor.fetchone()
+            
+            if not result or not result[0]:
+                return True
+                
+            last_time = datetime.fromisoformat(result[0])
+            return datetime.now() - last_time >= timedelta(hours=CONFIG_COOLDOWN_HOURS)
+    
+    def add_config(self, user_id):
+        with self.lock:
+            cursor = self.conn.cursor()
+            config_id = str(uuid.uuid4())
+            
+            cursor.execute(
+                "INSERT INTO configs (config_id, telegram_id, created_at) VALUES (?, ?, ?)",
+                (config_id, user_id, datetime.now())
+            )
+            
+            cursor.execute(
+                "UPDATE users SET last_config_time = ? WHERE telegram_id = ?",
+                (datetime.now().isoformat(), user_id)
+            )
+            
+            self.conn.commit()
+            self.data_version += 1
+            return config_id
+    
+    def release_jobs(self, worker_names):
+        # Задачи, прерванные остановкой, сразу возвращаются в очередь без ожидания visibility timeout
+        with self.lock:
+            cursor = self.conn.cursor()
+            cursor.executemany(
+                "UPDATE jobs SET status = 'pending', attempts = MAX(attempts - 1, 0), locked_by = NULL, "
+                "locked_until = NULL, updated_at = ? WHERE status = 'running' AND locked_by = ?",
+                [(time.time(), name) for name in worker_names]
+            )
+            self.conn.commit()
+            return cursor.rowcount
+    
+    def close(self):
+        with self.lock:
+            self.conn.commit()
+            self.conn.close()
+    
+    def get_version(self):
+        # PRAGMA data_version меняется, когда базу изменяет другое соединение (например, add_test_data.py)
+        with self.lock:
+            cursor = self.conn.cursor()
+            cursor.execute("PRAGMA data_version")
+            return self.data_version, cursor.fetchone()[0]
+    
+    def get_stats(self):
+        with self.lock:
+            cursor = self.conn.cursor()
+            
+            cursor.execute("SELECT COUNT(*) FROM users WHERE is_banned = 0")
+            active_users = cursor.fetchone()[0]
+            
+            cursor.execute("SELECT COUNT(*) FROM users WHERE is_banned = 1")
+            banned_users = cursor.fetchone()[0]
+            
+            cursor.execute("SELECT COUNT(*) FROM configs WHERE is_active = 1")
+            active_configs = cursor.fetchone()[0]
+            
+            cursor.execute("SELECT COUNT(*) FROM configs")
+            total_configs = cursor.fetchone()[0]
+            
+            return active_users, banned_users, active_configs, total_configs
     
     def get_users_list(self, limit=50):
-        cursor = self.conn.cursor()
-        cursor.execute(
-            "SELECT telegram_id, username, first_name, is_banned FROM users ORDER BY first_seen DESC LIMIT ?",
-            (limit,)
-        )
-        return cursor.fetchall()
+        with self.lock:
+            cursor = self.conn.cursor()
+            cursor.execute(
+                "SELECT telegram_id, username, first_name, is_banned FROM users ORDER BY first_seen DESC LIMIT ?",
+                (limit,)
+            )
+            return cursor.fetchall()
     
     def ban_user(self, user_id):
-        cursor = self.conn.cursor()
-        cursor.execute("UPDATE users SET is_banned = 1 WHERE telegram_id = ?", (user_id,))
-        self.conn.commit()
+        with self.lock:
+            cursor = self.conn.cursor()
+            cursor.execute("UPDATE users SET is_banned = 1 WHERE telegram_id = ?", (user_id,))
+            self.conn.commit()
+            self.data_version += 1
     
     def unban_user(self, user_id):
-        cursor = self.conn.cursor()
-        cursor.execute("UPDATE users SET is_banned = 0 WHERE telegram_id = ?", (user_id,))
-        self.conn.commit()
+        with self.lock:
+            cursor = self.conn.cursor()
+            cursor.execute("UPDATE users SET is_banned = 0 WHERE telegram_id = ?", (user_id,))
+            self.conn.commit()
+            self.data_version += 1
     
     def get_active_users(self):
-        cursor = self.conn.cursor()
-        cursor.execute("SELECT telegram_id FROM users WHERE is_banned = 0")
-        return [row[0] for row in cursor.fetchall()]
+        with self.lock:
+            cursor = self.conn.cursor()
+            cursor.execute("SELECT telegram_id FROM users WHERE is_banned = 0")
+            return [row[0] for row in cursor.fetchall()]
+    
+    def get_qr_file_id(self, payload_hash):
+        with self.lock:
+            cursor = self.conn.cursor()
+            cursor.execute("SELECT file_id FROM qr_cache WHERE payload_hash = ?", (payload_hash,))
+            result = cursor.fetchone()
+            return result[0] if result else None
+    
+    def save_qr_file_id(self, payload_hash, file_id):
+        with self.lock:
+            cursor = self.conn.cursor()
+            cursor.execute(
+                "INSERT OR REPLACE INTO qr_cache (payload_hash, file_id, created_at) VALUES (?, ?, ?)",
+                (payload_hash, file_id, datetime.now())
+            )
+            self.conn.commit()
+    
+    def forget_qr_file_id(self, payload_hash):
+        with self.lock:
+            cursor = self.conn.cursor()
+            cursor.execute("DELETE FROM qr_cache WHERE payload_hash = ?", (payload_hash,))
+            self.conn.commit()
+
+    def enqueue_jobs(self, jobs, priority=0, batch_id=None):
+        # jobs: список кортежей (kind, payload, idempotency_key); дубликаты по ключу игнорируются
+        now = time.time()
+        with self.lock:
+            cursor = self.conn.cursor()
+            cursor.executemany(
+                "INSERT OR IGNORE INTO jobs "
+                "(kind, payload, idempotency_key, run_at, created_at, updated_at, priority, batch_id) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                [(kind, json.dumps(payload), key, now, now, now, priority, batch_id) for kind, payload, key in jobs]
+            )
+            self.conn.commit()
+            return cursor.rowcount
+    
+    def claim_job(self, worker_name, visibility_timeout):
+        # Сначала задачи, чей воркер не отчитался за visibility_timeout, затем готовые — по приоритету
+        now = time.time()
+        with self.lock:
+            cursor = self.conn.cursor()
+            cursor.execute(
+                "SELECT job_id, kind, payload, attempts FROM jobs "
+                "WHERE status = 'running' AND locked_until <= ? ORDER BY priority, locked_until LIMIT 1",
+                (now,)
+            )
+            row = cursor.fetchone()
+            if not row:
+                cursor.execute(
+                    "SELECT job_id, kind, payload, attempts FROM jobs "
+                    "WHERE status = 'pending' AND run_at <= ? ORDER BY priority, run_at LIMIT 1",
+                    (now,)
+                )
+                row = cursor.fetchone()
+            if not row:
+                return None
+            
+            job_id, kind, payload, attempts = row
+            cursor.execute(
+                "UPDATE jobs SET status = 'running', attempts = attempts + 1, locked_by = ?, "
+                "locked_until = ?, updated_at = ? WHERE job_id = ?",
+                (worker_name, now + visibility_timeout, now, job_id)
+            )
+            self.conn.commit()
+        return job_id, kind, json.loads(payload), attempts + 1
+    
+    def complete_job(self, job_id):
+        with self.lock:
+            cursor = self.conn.cursor()
+            cursor.execute(
+                "UPDATE jobs SET status = 'done', locked_by = NULL, locked_until = NULL, updated_at = ? "
+                "WHERE job_id = ?",
+                (time.time(), job_id)
+            )
+            self.conn.commit()
+    
+    def retry_job(self, job_id, delay, error):
+        now = time.time()
+        with self.lock:
+            cursor = self.conn.cursor()
+            cursor.execute(
+                "UPDATE jobs SET status = 'pending', run_at = ?, locked_by = NULL, locked_until = NULL, "
+                "last_error = ?, updated_at = ? WHERE job_id = ?",
+                (now + delay, error, now, job_id)
+            )
+            self.conn.commit()
+    
+    def postpone_job(self, job_id, delay):
+        # Задача ещё не может быть выполнена (например, отчёт о незавершённой рассылке): попытка не считается
+        now = time.time()
+        with self.lock:
+            cursor = self.conn.cursor()
+            cursor.execute(
+                "UPDATE jobs SET status = 'pending', run_at = ?, attempts = MAX(attempts - 1, 0), "
+                "locked_by = NULL, locked_until = NULL, updated_at = ? WHERE job_id = ?",
+                (now + delay, now, job_id)
+            )
+            self.conn.commit()
+    
+    def get_batch_counts(self, batch_id):
+        with self.lock:
+            cursor = self.conn.cursor()
+            cursor.execute("SELECT status, COUNT(*) FROM jobs WHERE batch_id = ? GROUP BY status", (batch_id,))
+            return dict(cursor.fetchall())
+    
+    def fail_job(self, job_id, error):
+        with self.lock:
+            cursor = self.conn.cursor()
+            cursor.execute(
+                "UPDATE jobs SET status = 'failed', locked_by = NULL, locked_until = NULL, "
+                "last_error = ?, updated_at = ? WHERE job_id = ?",
+                (error, time.time(), job_id)
+            )
+            self.conn.commit()
+    
+    def get_job_counts(self):
+        with self.lock:
+            cursor = self.conn.cursor()
+            cursor.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status")
+            return dict(cursor.fetchall())
+
+    def mark_update_seen(self, update_key):
+        # Возвращает False, если ключ уже был записан (например, до перезапуска)
+        with self.lock:
+            cursor = self.conn.cursor()
+            cursor.execute(
+                "INSERT OR IGNORE INTO seen_updates (update_key, seen_at) VALUES (?, ?)",
+                (update_key, time.time())
+            )
+            self.conn.commit()
+            return cursor.rowcount == 1
+    
+    def prune_seen_updates(self, max_age):
+        with self.lock:
+            cursor = self.conn.cursor()
+            cursor.execute("DELETE FROM seen_updates WHERE seen_at < ?", (time.time() - max_age,))
+            self.conn.commit()
+
+    def get_or_create_referral_code(self, user_id):
+        with self.lock:
+            cursor = self.conn.cursor()
+            cursor.execute("SELECT code FROM referral_codes WHERE telegram_id = ?", (user_id,))
+            result = cursor.fetchone()
+            if result:
+                return result[0]
+            
+            while True:
+                code = secrets.token_hex(4)
+                cursor.execute(
+                    "INSERT OR IGNORE INTO referral_codes (code, telegram_id, created_at) VALUES (?, ?, ?)",
+                    (code, user_id, datetime.now())
+                )
+                if cursor.rowcount:
+                    self.conn.commit()
+                    return code
+    
+    def get_referral_owner(self, code):
+        with self.lock:
+            cursor = self.conn.cursor()
+            cursor.execute("SELECT telegram_id FROM referral_codes WHERE code = ?", (code,))
+            result = cursor.fetchone()
+            return result[0] if result else None
+    
+    def redeem_referral(self, referred_id, referrer_id, code, bonus):
+        # Запись активации и начисление бонусов обоим пользователям в одной транзакции
+        now = datetime.now()
+        with self.lock, self.conn:
+            cursor = self.conn.cursor()
+            cursor.execute(
+                "INSERT OR IGNORE INTO referral_redemptions (referred_id, referrer_id, code, redeemed_at) "
+                "VALUES (?, ?, ?, ?)",
+                (referred_id, referrer_id, code, now)
+            )
+            if not cursor.rowcount:
+                return False
+            
+            cursor.executemany(
+                "INSERT INTO xray_quota_ledger (telegram_id, kind, delta, reason, created_at) "
+                "VALUES (?, 'bonus', ?, ?, ?)",
+                [
+                    (referrer_id, bonus, f"referral:{referred_id}", now),
+                    (referred_id, bonus, f"referral_code:{code}", now),
+                ]
+            )
+            return True
+    
+    def add_quota_entry(self, user_id, kind, delta, day, reason):
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT INTO xray_quota_ledger (telegram_id, kind, delta, day, reason, created_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (user_id, kind, delta, day, reason, datetime.now())
+            )
+    
+    def get_quota_totals(self, user_id, day):
+        # (израсходовано дневного лимита за day, остаток бонусов)
+        with self.lock:
+            cursor = self.conn.cursor()
+            cursor.execute(
+                "SELECT COALESCE(-SUM(delta), 0) FROM xray_quota_ledger "
+                "WHERE telegram_id = ? AND kind = 'daily' AND day = ?",
+                (user_id, day)
+            )
+            daily_used = cursor.fetchone()[0]
+            cursor.execute(
+                "SELECT COALESCE(SUM(delta), 0) FROM xray_quota_ledger WHERE telegram_id = ? AND kind = 'bonus'",
+                (user_id,)
+            )
+            return daily_used, cursor.fetchone()[0]
+
+# Квота запросов Xray: баланс пользователя кэшируется в памяти, журнал в базе только дополняется
+class XrayQuota:
+    def __init__(self, database, daily_limit, referral_bonus, max_size):
+        self.db = database
+        self.daily_limit = daily_limit
+        self.referral_bonus = referral_bonus
+        self.max_size = max_size
+        self.day = None
+        self.balances = OrderedDict()  # user_id -> [день, израсходовано за день, остаток бонусов]
+    
+    def _balance(self, user_id, today):
+        # С наступлением нового дня все сохранённые балансы устаревают
+        if today != self.day:
+            self.balances.clear()
+            self.day = today
+        
+        balance = self.balances.get(user_id)
+        if balance is None:
+            daily_used, bonus = self.db.get_quota_totals(user_id, today)
+            balance = self.balances[user_id] = [today, daily_used, bonus]
+            while len(self.balances) > self.max_size:
+                self.balances.popitem(last=False)
+        else:
+            self.balances.move_to_end(user_id)
+        return balance
+    
+    def remaining(self, user_id):
+        today = date.today().isoformat()
+        with self.db.lock:
+            _, daily_used, bonus = self._balance(user_id, today)
+            return max(self.daily_limit - daily_used, 0) + bonus
+    
+    def consume(self, user_id, reason):
+        # Сначала тратится дневной лимит, затем бонусы; False, если запросов не осталось
+        today = date.today().isoformat()
+        with self.db.lock:
+            balance = self._balance(user_id, today)
+            if balance[1] < self.daily_limit:
+                self.db.add_quota_entry(user_id, 'daily', -1, today, reason)
+                balance[1] += 1
+            elif balance[2] > 0:
+                self.db.add_quota_entry(user_id, 'bonus', -1, today, reason)
+                balance[2] -= 1
+            else:
+                return False
+        return True
+    
+    def redeem(self, user_id, code):
+        # Возвращает None при успехе или текст ошибки для пользователя
+        code = code.strip().lstrip(':').lower()
+        referrer_id = self.db.get_referral_owner(code)
+        if referrer_id is None:
+            return "❌ Реферальный код не найден."
+        if referrer_id == user_id:
+            return "❌ Нельзя активировать собственный реферальный код."
+        
+        with self.db.lock:
+            if not self.db.redeem_referral(user_id, referrer_id, code, self.referral_bonus):
+                return "❌ Вы уже активировали реферальный код."
+            # Кэш правим под той же блокировкой, чтобы параллельные активации не потерялись
+            for telegram_id in (user_id, referrer_id):
+                balance = self.balances.get(telegram_id)
+                if balance is not None:
+                    balance[2] += self.referral_bonus
+        return None
+
+# Обработанные update_id/callback_id: ограниченный кэш в памяти с TTL поверх таблицы seen_updates
+class SeenUpdates:
+    def __init__(self, database, ttl, max_size, prune_every):
+        self.db = database
+        self.ttl = ttl
+        self.max_size = max_size
+        self.prune_every = prune_every
+        self.recent = OrderedDict()
+        self.inserts = 0
+    
+    def check_and_mark(self, update_key):
+        now = time.time()
+        
+        seen_at = self.recent.get(update_key)
+        if seen_at is not None and now - seen_at < self.ttl:
+            return False
+        
+        self.recent[update_key] = now
+        self.recent.move_to_end(update_key)
+        while len(self.recent) > self.max_size:
+            self.recent.popitem(last=False)
+        
+        self.inserts += 1
+        if self.inserts % self.prune_every == 0:
+            self.db.prune_seen_updates(self.ttl)
+        
+        return self.db.mark_update_seen(update_key)
+
+# Кэш статистики для дашборда: пересчитывается только при смене версии данных
+class StatsCache:
+    def __init__(self, database):
+        self.db = database
+        self.lock = threading.Lock()
+        self.version = None
+        self.stats = None
+    
+    def get(self):
+        version = self.db.get_version()
+        with self.lock:
+            if version != self.version:
+                self.stats = self.db.get_stats()
+                self.version = version
+                metrics.inc("stats_cache_miss")
+            return self.stats
+
+# Простые метрики процесса: счётчики и суммарное время операций
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.timings = {}
+    
+    def inc(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+    
+    def observe(self, name, seconds):
+        with self.lock:
+            count, total, peak = self.timings.get(name, (0, 0.0, 0.0))
+            self.timings[name] = (count + 1, total + seconds, max(peak, seconds))
+    
+    def format_report(self):
+        with self.lock:
+            lines = [f"{name}: {value}" for name, value in sorted(self.counters.items())]
+            for name, (count, total, peak) in sorted(self.timings.items()):
+                lines.append(
+                    f"{name}: {count} шт., среднее {total / count * 1000:.1f} мс, "
+                    f"макс. {peak * 1000:.1f} мс"
+                )
+        return "\n".join(lines)
 
 # Инициализация базы данных
 db = Database()
+metrics = Metrics()
 
-def generate_warp_config():
-    config = """[Interface]
+stats_cache = StatsCache(db)
+xray_quota = XrayQuota(db, XRAY_DAILY_LIMIT, REFERRAL_BONUS, XRAY_QUOTA_MEMORY_SIZE)
+seen_updates = SeenUpdates(db, SEEN_UPDATES_TTL, SEEN_UPDATES_MEMORY_SIZE, SEEN_UPDATES_PRUNE_EVERY)
+
+# Пул потоков для отрисовки QR-кодов, чтобы не блокировать цикл событий
+qr_executor = ThreadPoolExecutor(max_workers=QR_RENDER_WORKERS, thread_name_prefix="qr-render")
+
+DEFAULT_WARP_CONFIG = """[Interface]
 PrivateKey = CS/UQwV5cCjhGdH/1FQbSkRLvYU8Ha1xeTkHVg5rizI=
 S1 = 0
 S2 = 0
@@ -176,139 +795,384 @@ PublicKey = bmXOC+F1FxEMF9dyiK2H5/1SUtzH0JuVo51h2wPfgyo=
 AllowedIPs = 0.0.0.0/0, ::/0
 Endpoint = 162.159.192.227:894
 """
-    return config
 
-def is_admin(user_id):
-    return user_id == ADMIN_TELEGRAM_ID
+def load_warp_config(path):
+    if not path:
+        return DEFAULT_WARP_CONFIG
+    with open(path, encoding='utf-8') as f:
+        return f.read()
 
-def get_main_keyboard(user_id):
-    keyboard = [
+WARP_CONFIG = load_warp_config(SETTINGS["WARP_CONFIG_FILE"])
+
+def generate_warp_config():
+    return WARP_CONFIG
+
+def render_qr_png(payload):
+    # qrcode (и Pillow) нужны только для QR-доставки, поэтому импортируем при первом использовании
+    import qrcode
+    
+    qr = qrcode.QRCode(error_correction=qrcode.constants.ERROR_CORRECT_L, box_size=8, border=4)
+    qr.add_data(payload)
+    qr.make(fit=True)
+    
+    buffer = io.BytesIO()
+    qr.make_image(fill_color="black", back_color="white").save(buffer, format="PNG")
+    return buffer.getvalue()
+
+async def render_qr_png_async(payload):
+    loop = asyncio.get_running_loop()
+    started = time.perf_counter()
+    png = await loop.run_in_executor(qr_executor, render_qr_png, payload)
+    metrics.observe("qr_render", time.perf_counter() - started)
+    return png
+
+# Ошибки доставки рассылок собираются в сводку вместо предупреждения на каждого пользователя
+BROADCAST_SUMMARY_INTERVAL = 30  # Как часто выводить сводку во время рассылки, секунд
+
+class BroadcastFailureSummary:
+    def __init__(self, interval):
+        self.interval = interval
+        self.failures = {}  # broadcast_id -> Counter(причина -> количество)
+        self.last_flush = time.monotonic()
+    
+    def record(self, broadcast_id, error):
+        reason = f"{type(error).__name__}: {error}"
+        self.failures.setdefault(broadcast_id, Counter())[reason] += 1
+        if time.monotonic() - self.last_flush >= self.interval:
+            self.flush()
+    
+    def flush(self):
+        self.last_flush = time.monotonic()
+        failures, self.failures = self.failures, {}
+        for broadcast_id, reasons in failures.items():
+            total = sum(reasons.values())
+            logger.warning(
+                "Рассылка %s: не доставлено %d сообщений", broadcast_id, total,
+                extra={
+                    "event": "broadcast_failures",
+                    "broadcast_id": broadcast_id,
+                    "failed": total,
+                    "reasons": dict(reasons.most_common(10)),
+                }
+            )
+
+broadcast_failures = BroadcastFailureSummary(BROADCAST_SUMMARY_INTERVAL)
+
+# Очередь фоновых задач: исходящие вызовы Telegram выполняются воркерами в цикле событий бота
+job_loop = None  # Цикл событий бота, в котором работают воркеры
+job_wakeup = None  # asyncio.Event, будящий воркеров при появлении задач
+job_workers = []
+job_stopping = False  # Воркеры дорабатывают текущую задачу и выходят
+
+def enqueue_job(kind, payload, idempotency_key=None):
+    return enqueue_jobs([(kind, payload, idempotency_key)])
+
+def enqueue_jobs(jobs, priority=JOB_PRIORITY_DEFAULT, batch_id=None):
+    added = db.enqueue_jobs(jobs, priority, batch_id)
+    # Может вызываться как из потока Flask, так и из цикла бота
+    if job_loop is not None and job_wakeup is not None and not job_loop.is_closed():
+        job_loop.call_soon_threadsafe(job_wakeup.set)
+    return added
+
+def job_retry_delay(attempts):
+    return JOB_RETRY_BASE_DELAY * 2 ** (attempts - 1)
+
+async def job_send_message(bot, payload):
+    await bot.send_message(chat_id=payload["chat_id"], text=payload["text"])
+    await asyncio.sleep(JOB_SEND_DELAY)
+
+class JobNotReady(Exception):
+    # Задача выполнится позже; попытка не засчитывается
+    def __init__(self, delay):
+        super().__init__(f"повтор через {delay} с")
+        self.delay = delay
+
+async def job_broadcast(bot, payload):
+    # Разворачиваем рассылку в отдельные задачи: при перезапуске уже отправленные не повторятся
+    broadcast_id = payload["broadcast_id"]
+    text = f"📢 Сообщение от администратора:\n\n{payload['message']}"
+    users = db.get_active_users()
+    enqueue_jobs(
         [
-            InlineKeyboardButton("Получить конфиг", callback_data="get_config"),
-            InlineKeyboardButton("Справка", callback_data="help"),
+            (
+                "send_message",
+                {"chat_id": user_id, "text": text, "broadcast_id": broadcast_id},
+                f"broadcast:{broadcast_id}:{user_id}"
+            )
+            for user_id in users
         ],
-        [
-            InlineKeyboardButton("XrayVPN", url="https://astracat2022.github.io/info"),
-        ]
-    ]
+        priority=JOB_PRIORITY_BROADCAST,
+        batch_id=broadcast_id
+    )
+    # Отчёт идёт с обычным приоритетом, чтобы обновляться, пока рассылка ещё идёт
+    enqueue_job(
+        "broadcast_report",
+        {
+            "broadcast_id": broadcast_id,
+            "chat_ids": payload.get("report_chat_ids", []),
+            "message_id": payload.get("report_message_id"),
+        },
+        f"broadcast_report:{broadcast_id}"
+    )
+    logger.info(
+        "Рассылка %s поставлена в очередь для %d пользователей", broadcast_id, len(users),
+        extra={"event": "broadcast_enqueued", "broadcast_id": broadcast_id, "recipients": len(users)}
+    )
+
+async def send_broadcast_report(bot, payload, text):
+    message_id = payload.get("message_id")
+    for chat_id in payload["chat_ids"]:
+        if message_id:
+            try:
+                await bot.edit_message_text(chat_id=chat_id, message_id=message_id, text=text)
+                continue
+            except BadRequest as e:
+                # Текст не изменился — ничего делать не нужно; иначе сообщение удалено, отправляем новое
+                if "not modified" in str(e).lower():
+                    continue
+        await bot.send_message(chat_id=chat_id, text=text)
+
+async def job_broadcast_report(bot, payload):
+    counts = db.get_batch_counts(payload["broadcast_id"])
+    success = counts.get('done', 0)
+    failed = counts.get('failed', 0)
     
-    if is_admin(user_id):
-        keyboard.append([
-            InlineKeyboardButton("Статистика", callback_data="stats"),
-            InlineKeyboardButton("Пользователи", callback_data="users"),
-        ])
+    if counts.get('pending', 0) or counts.get('running', 0):
+        if payload.get("message_id"):
+            await send_broadcast_report(
+                bot, payload,
+                f"Рассылка в процессе...\n✅ Успешно: {success}\n❌ Не удалось: {failed}"
+            )
+        raise JobNotReady(BROADCAST_REPORT_INTERVAL)
     
-    return InlineKeyboardMarkup(keyboard)
+    await send_broadcast_report(
+        bot, payload,
+        f"Рассылка завершена:\n✅ Успешно: {success}\n❌ Не удалось: {failed}"
+    )
 
-# Flask routes
-@app.route('/')
-async def index():
-    if 'logged_in' not in session:
-        return redirect(url_for('login'))
+JOB_HANDLERS = {
+    "send_message": job_send_message,
+    "broadcast": job_broadcast,
+    "broadcast_report": job_broadcast_report,
+}
+
+def report_job_failure(job_id, kind, payload, error, message):
+    metrics.inc("jobs_failed")
+    broadcast_id = payload.get("broadcast_id")
+    if broadcast_id:
+        broadcast_failures.record(broadcast_id, error)
+    else:
+        logger.warning(
+            "Задача %s (%s) %s: %s", job_id, kind, message, error,
+            extra={"event": "job_failed", "job_id": job_id, "kind": kind}
+        )
+
+async def run_job(bot, worker_name):
+    job = db.claim_job(worker_name, JOB_VISIBILITY_TIMEOUT)
+    if job is None:
+        return False
     
-    active_users, banned_users, active_configs, total_configs = db.get_stats()
-    stats_text = (
-        "📊 Статистика бота:\n\n"
-        f"👥 Пользователи: {active_users} активных, {banned_users} забаненных\n"
-        f"📂 Конфигурации: {active_configs} активных, {total_configs} всего"
-    )
+    job_id, kind, payload, attempts = job
+    handler = JOB_HANDLERS.get(kind)
+    if handler is None:
+        db.fail_job(job_id, f"Неизвестный тип задачи: {kind}")
+        return True
     
-    # Проверка связи с Telegram API
     try:
-        await application.bot.get_me()
-        api_status = {"connected": True, "message": "🟢 Подключено"}
+        await handler(bot, payload)
+    except JobNotReady as e:
+        db.postpone_job(job_id, e.delay)
+    except (Forbidden, BadRequest) as e:
+        # Пользователь заблокировал бота или чат не найден: повтор не поможет
+        db.fail_job(job_id, str(e))
+        report_job_failure(job_id, kind, payload, e, "отклонена Telegram")
+    except RetryAfter as e:
+        db.retry_job(job_id, e.retry_after, str(e))
+        metrics.inc("jobs_retried")
     except Exception as e:
-        api_status = {"connected": False, "message": f"🔴 Отключено: {str(e)}"}
-    
-    return render_template('index.html', stats_text=stats_text, api_status=api_status)
+        if attempts >= JOB_MAX_ATTEMPTS:
+            db.fail_job(job_id, str(e))
+            report_job_failure(job_id, kind, payload, e, f"не выполнена после {attempts} попыток")
+        else:
+            db.retry_job(job_id, job_retry_delay(attempts), str(e))
+            metrics.inc("jobs_retried")
+    else:
+        db.complete_job(job_id)
+        metrics.inc("jobs_done")
+    return True
 
-@app.route('/login', methods=['GET', 'POST'])
-def login():
-    if request.method == 'POST':
-        username = request.form['username']
-        password = request.form['password']
+async def job_worker(bot, worker_name):
+    while not job_stopping:
+        try:
+            if await run_job(bot, worker_name):
+                continue
+            # Очередь опустела: выводим накопленную сводку ошибок рассылок
+            if broadcast_failures.failures:
+                broadcast_failures.flush()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error("Ошибка воркера %s: %s", worker_name, e, exc_info=e, extra={"event": "worker_error"})
         
-        if username == ADMIN_USERNAME and check_password_hash(ADMIN_PASSWORD_HASH, password):
-            session['logged_in'] = True
-            flash('Успешный вход!', 'success')
-            return redirect(url_for('index'))
-        else:
-            flash('Неверное имя пользователя или пароль.', 'error')
-    
-    return render_template('login.html')
+        try:
+            await asyncio.wait_for(job_wakeup.wait(), timeout=JOB_POLL_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+        job_wakeup.clear()
 
-@app.route('/logout')
-def logout():
-    session.pop('logged_in', None)
-    flash('Вы вышли из системы.', 'info')
-    return redirect(url_for('login'))
+def job_worker_names():
+    # PID в имени, чтобы при остановке не вернуть в очередь задачи другого процесса
+    return [f"{os.getpid()}-worker-{i}" for i in range(JOB_WORKERS)]
 
-@app.route('/users')
-def users():
-    if 'logged_in' not in session:
-        return redirect(url_for('login'))
-    
-    users = db.get_users_list()
-    return render_template('users.html', users=users)
+async def start_job_workers(application):
+    global job_loop, job_wakeup, job_stopping
+    job_loop = asyncio.get_running_loop()
+    job_wakeup = asyncio.Event()
+    job_stopping = False
+    for worker_name in job_worker_names():
+        job_workers.append(asyncio.create_task(job_worker(application.bot, worker_name)))
 
-@app.route('/ban/<int:user_id>')
-def ban_user(user_id):
-    if 'logged_in' not in session:
-        return redirect(url_for('login'))
+async def stop_job_workers(application):
+    global job_stopping
+    # post_stop вызывается и после неудачного запуска, когда воркеры ещё не созданы
+    if job_wakeup is None or not job_workers:
+        return
+    job_stopping = True
+    job_wakeup.set()
+    
+    # Даём воркерам закончить текущую задачу, зависшие отменяем
+    _, pending = await asyncio.wait(job_workers, timeout=JOB_SHUTDOWN_TIMEOUT)
+    for task in pending:
+        task.cancel()
+    await asyncio.gather(*job_workers, return_exceptions=True)
+    job_workers.clear()
     
-    db.ban_user(user_id)
-    flash(f'Пользователь {user_id} забанен.', 'success')
-    return redirect(url_for('users'))
+    released = db.release_jobs(job_worker_names())
+    counts = db.get_job_counts()
+    logger.info(
+        "Воркеры очереди остановлены: возвращено в очередь %d задач, ожидают выполнения %d",
+        released, counts.get('pending', 0),
+        extra={"event": "jobs_checkpointed", "released": released, "pending": counts.get('pending', 0)}
+    )
 
-@app.route('/unban/<int:user_id>')
-def unban_user(user_id):
-    if 'logged_in' not in session:
-        return redirect(url_for('login'))
+# Состояние связи с Telegram API обновляется в фоне, а не на каждый запрос дашборда
+telegram_health = {"connected": False, "message": "⚪ Проверка ещё не выполнялась", "checked_at": None}
+health_probe_task = None
+
+async def check_telegram_health(bot):
+    try:
+        await bot.get_me()
+        status = {"connected": True, "message": "🟢 Подключено"}
+    except Exception as e:
+        status = {"connected": False, "message": f"🔴 Отключено: {str(e)}"}
+    status["checked_at"] = datetime.now().isoformat(timespec="seconds")
+    telegram_health.update(status)
+
+async def health_probe(bot):
+    while True:
+        await check_telegram_health(bot)
+        await asyncio.sleep(TELEGRAM_HEALTH_INTERVAL)
+
+async def start_health_probe(application):
+    global health_probe_task
+    health_probe_task = asyncio.create_task(health_probe(application.bot))
+
+async def stop_health_probe(application):
+    global health_probe_task
+    if health_probe_task is None:
+        return
+    health_probe_task.cancel()
+    await asyncio.gather(health_probe_task, return_exceptions=True)
+    health_probe_task = None
+
+async def post_init(application):
+    await start_job_workers(application)
+    await start_health_probe(application)
+    start_web_server()
     
-    db.unban_user(user_id)
-    flash(f'Пользователь {user_id} разбанен.', 'success')
-    return redirect(url_for('users'))
+    # SIGHUP перечитывает настройки без перезапуска
+    if hasattr(signal, "SIGHUP"):
+        try:
+            asyncio.get_running_loop().add_signal_handler(signal.SIGHUP, reload_settings)
+        except NotImplementedError:
+            pass
 
-@app.route('/broadcast', methods=['GET', 'POST'])
-async def broadcast():
-    if 'logged_in' not in session:
-        return redirect(url_for('login'))
+async def post_stop(application):
+    # Вызывается после того, как Application.stop() дождался обработки текущих обновлений;
+    # бот ещё подключён, поэтому воркеры могут доотправить текущие сообщения
+    logger.info("Остановка: завершаю веб-интерфейс и очередь задач", extra={"event": "shutdown"})
+    await asyncio.to_thread(stop_web_server)
+    await stop_health_probe(application)
+    await stop_job_workers(application)
+    broadcast_failures.flush()
+
+async def post_shutdown(application):
+    qr_executor.shutdown(wait=True)
+    db.close()
+    logger.info("Бот остановлен", extra={"event": "shutdown_complete"})
+
+def format_stats_text(stats):
+    active_users, banned_users, active_configs, total_configs = stats
+    return (
+        "📊 Статистика бота:\n\n"
+        f"👥 Пользователи: {active_users} активных, {banned_users} забаненных\n"
+        f"📂 Конфигурации: {active_configs} активных, {total_configs} всего"
+    )
+
+def get_dashboard_payload():
+    active_users, banned_users, active_configs, total_configs = stats = stats_cache.get()
+    return {
+        "stats": {
+            "active_users": active_users,
+            "banned_users": banned_users,
+            "active_configs": active_configs,
+            "total_configs": total_configs,
+        },
+        "stats_text": format_stats_text(stats),
+        "api_status": dict(telegram_health),
+    }
+
+def dashboard_etag(body):
+    return hashlib.sha1(body.encode('utf-8')).hexdigest()
+
+@functools.lru_cache(maxsize=None)
+def get_admin_password_hash():
+    if ADMIN_PASSWORD_HASH:
+        return ADMIN_PASSWORD_HASH
+    if not ADMIN_PASSWORD:
+        return None
+    # Хэширование дорогое, поэтому считаем его один раз при первом входе
+    from werkzeug.security import generate_password_hash
+    return generate_password_hash(ADMIN_PASSWORD)
+
+def is_admin(user_id):
+    return user_id in ADMIN_IDS
+
+def get_main_keyboard(user_id):
+    keyboard = [
+        [
+            InlineKeyboardButton("Получить конфиг", callback_data="get_config"),
+            InlineKeyboardButton("Справка", callback_data="help"),
+        ],
+        [
+            InlineKeyboardButton("QR-код конфига", callback_data="get_config_qr"),
+        ],
+        [
+            InlineKeyboardButton("XrayVPN", url="https://astracat2022.github.io/info"),
+            InlineKeyboardButton("Запрос Xray", callback_data="xray_request"),
+        ]
+    ]
     
-    if request.method == 'POST':
-        message = request.form.get('message')
-        if not message:
-            flash('Сообщение не может быть пустым.', 'error')
-            return redirect(url_for('broadcast'))
-        
-        users = db.get_active_users()
-        if not users:
-            flash('Нет активных пользователей для рассылки.', 'warning')
-            return redirect(url_for('broadcast'))
-        
-        success = 0
-        failed = 0
-        
-        for user_id in users:
-            try:
-                await application.bot.send_message(
-                    chat_id=user_id,
-                    text=f"📢 Сообщение от администратора:\n\n{message}"
-                )
-                success += 1
-            except Exception as e:
-                failed += 1
-                logger.warning(f"Не удалось отправить сообщение пользователю {user_id}: {e}")
-            
-            # Небольшая задержка, чтобы не превысить лимиты Telegram
-            await asyncio.sleep(0.1)
-        
-        flash(f"Рассылка завершена: ✅ Успешно: {success}, ❌ Не удалось: {failed}", 'success')
-        return redirect(url_for('broadcast'))
+    if is_admin(user_id):
+        keyboard.append([
+            InlineKeyboardButton("Статистика", callback_data="stats"),
+            InlineKeyboardButton("Пользователи", callback_data="users"),
+        ])
     
-    return render_template('broadcast.html')
+    return InlineKeyboardMarkup(keyboard)
 
 # HTML Templates
-TEMPLATES = {
+DEFAULT_TEMPLATES = {
     'index.html': '''
     <!DOCTYPE html>
     <html lang="en">
@@ -340,14 +1204,27 @@ TEMPLATES = {
                 {% endfor %}
                 <div class="bg-white p-6 rounded-lg shadow-md mb-6">
                     <h2 class="text-xl font-semibold mb-4">Статус Telegram API</h2>
-                    <p class="{% if api_status.connected %}text-green-600{% else %}text-red-600{% endif %} font-medium">{{ api_status.message }}</p>
+                    <p id="api-status" class="{% if api_status.connected %}text-green-600{% else %}text-red-600{% endif %} font-medium">{{ api_status.message }}</p>
                 </div>
                 <div class="bg-white p-6 rounded-lg shadow-md">
                     <h2 class="text-xl font-semibold mb-4">Статистика</h2>
-                    <pre class="bg-gray-100 p-4 rounded-lg">{{ stats_text }}</pre>
+                    <pre id="stats-text" class="bg-gray-100 p-4 rounded-lg">{{ stats_text }}</pre>
                 </div>
             </div>
         </div>
+        <script>
+            // Живое обновление счётчиков без перезагрузки страницы
+            if (window.EventSource) {
+                const source = new EventSource("{{ url_for('api_stats_stream') }}");
+                source.onmessage = function (event) {
+                    const payload = JSON.parse(event.data);
+                    const status = document.getElementById("api-status");
+                    status.textContent = payload.api_status.message;
+                    status.className = (payload.api_status.connected ? "text-green-600" : "text-red-600") + " font-medium";
+                    document.getElementById("stats-text").textContent = payload.stats_text;
+                };
+            }
+        </script>
     </body>
     </html>
     ''',
@@ -492,17 +1369,227 @@ TEMPLATES = {
     '''
 }
 
-# Создание шаблонов
-import os
-os.makedirs('templates', exist_ok=True)
-for filename, content in TEMPLATES.items():
-    with open(os.path.join('templates', filename), 'w', encoding='utf-8') as f:
-        f.write(content)
+def load_templates(templates_dir):
+    # Файлы *.html из TEMPLATES_DIR заменяют встроенные шаблоны с тем же именем
+    templates = dict(DEFAULT_TEMPLATES)
+    if templates_dir:
+        for filename in os.listdir(templates_dir):
+            if filename.endswith('.html'):
+                with open(os.path.join(templates_dir, filename), encoding='utf-8') as f:
+                    templates[filename] = f.read()
+    return templates
+
+TEMPLATES = load_templates(SETTINGS["TEMPLATES_DIR"])
+
+# Flask-приложение собирается лениво: Flask и werkzeug импортируются только при запуске веб-интерфейса
+def create_app():
+    from flask import Flask, Response, jsonify, render_template, request, redirect, url_for, flash, session
+    from jinja2 import DictLoader
+    from werkzeug.security import check_password_hash
+    
+    app = Flask(__name__)
+    app.secret_key = WEB_SECRET_KEY
+    # Шаблоны берём из памяти, а не записываем на диск при импорте
+    app.jinja_loader = DictLoader(TEMPLATES)
+    
+    @app.route('/')
+    def index():
+        if 'logged_in' not in session:
+            return redirect(url_for('login'))
+    
+        payload = get_dashboard_payload()
+        return render_template('index.html', stats_text=payload["stats_text"], api_status=payload["api_status"])
+    
+    @app.route('/api/stats')
+    def api_stats():
+        if 'logged_in' not in session:
+            return jsonify({"error": "unauthorized"}), 401
+    
+        body = json.dumps(get_dashboard_payload(), ensure_ascii=False)
+        etag = dashboard_etag(body)
+        if etag in request.if_none_match:
+            metrics.inc("stats_api_not_modified")
+            response = Response(status=304)
+        else:
+            response = Response(body, mimetype='application/json')
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'private, no-cache'
+        return response
+    
+    @app.route('/api/stats/stream')
+    def api_stats_stream():
+        if 'logged_in' not in session:
+            return jsonify({"error": "unauthorized"}), 401
+    
+        def events():
+            last_etag = None
+            last_sent = 0
+            while not shutdown_event.is_set():
+                body = json.dumps(get_dashboard_payload(), ensure_ascii=False)
+                etag = dashboard_etag(body)
+                now = time.monotonic()
+                if etag != last_etag:
+                    last_etag = etag
+                    last_sent = now
+                    yield f"id: {etag}\ndata: {body}\n\n"
+                elif now - last_sent >= DASHBOARD_STREAM_HEARTBEAT:
+                    last_sent = now
+                    yield ": ping\n\n"
+                shutdown_event.wait(DASHBOARD_STREAM_INTERVAL)
+    
+        response = Response(events(), mimetype='text/event-stream')
+        response.headers['Cache-Control'] = 'no-cache'
+        response.headers['X-Accel-Buffering'] = 'no'
+        return response
+
+    @app.route('/login', methods=['GET', 'POST'])
+    def login():
+        if request.method == 'POST':
+            username = request.form['username']
+            password = request.form['password']
+        
+            password_hash = get_admin_password_hash()
+            if username == ADMIN_USERNAME and password_hash and check_password_hash(password_hash, password):
+                session['logged_in'] = True
+                flash('Успешный вход!', 'success')
+                return redirect(url_for('index'))
+            else:
+                flash('Неверное имя пользователя или пароль.', 'error')
+    
+        return render_template('login.html')
+
+    @app.route('/logout')
+    def logout():
+        session.pop('logged_in', None)
+        flash('Вы вышли из системы.', 'info')
+        return redirect(url_for('login'))
+
+    @app.route('/users')
+    def users():
+        if 'logged_in' not in session:
+            return redirect(url_for('login'))
+    
+        users = db.get_users_list()
+        return render_template('users.html', users=users)
+
+    @app.route('/ban/<int:user_id>')
+    def ban_user(user_id):
+        if 'logged_in' not in session:
+            return redirect(url_for('login'))
+    
+        db.ban_user(user_id)
+        enqueue_job("send_message", {"chat_id": user_id, "text": "⛔ Вы были забанены администратором."})
+        flash(f'Пользователь {user_id} забанен.', 'success')
+        return redirect(url_for('users'))
+
+    @app.route('/unban/<int:user_id>')
+    def unban_user(user_id):
+        if 'logged_in' not in session:
+            return redirect(url_for('login'))
+    
+        db.unban_user(user_id)
+        enqueue_job("send_message", {"chat_id": user_id, "text": "✅ Вы были разбанены администратором."})
+        flash(f'Пользователь {user_id} разбанен.', 'success')
+        return redirect(url_for('users'))
+
+    @app.route('/broadcast', methods=['GET', 'POST'])
+    def broadcast():
+        if 'logged_in' not in session:
+            return redirect(url_for('login'))
+    
+        if request.method == 'POST':
+            message = request.form.get('message')
+            if not message:
+                flash('Сообщение не может быть пустым.', 'error')
+                return redirect(url_for('broadcast'))
+        
+            users = db.get_active_users()
+            if not users:
+                flash('Нет активных пользователей для рассылки.', 'warning')
+                return redirect(url_for('broadcast'))
+        
+            broadcast_id = str(uuid.uuid4())
+            enqueue_job(
+                "broadcast",
+                {"broadcast_id": broadcast_id, "message": message, "report_chat_ids": sorted(ADMIN_IDS)},
+                f"broadcast:{broadcast_id}"
+            )
+        
+            flash(
+                f"Рассылка поставлена в очередь для {len(users)} пользователей. "
+                "Итог придёт администраторам в Telegram.", 'success'
+            )
+            return redirect(url_for('broadcast'))
+    
+        return render_template('broadcast.html')
+    
+    return app
 
 # Telegram Bot Handlers
+def timed_handler(callback):
+    # Пишет в лог и метрики время работы обработчика
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        started = time.perf_counter()
+        try:
+            return await callback(update, context)
+        finally:
+            latency = time.perf_counter() - started
+            metrics.observe(f"handler_{callback.__name__}", latency)
+            user = update.effective_user if isinstance(update, Update) else None
+            logger.info(
+                "Обработчик %s завершён за %.1f мс", callback.__name__, latency * 1000,
+                extra={
+                    "handler": callback.__name__,
+                    "user_id": user.id if user else None,
+                    "latency_ms": round(latency * 1000, 1),
+                }
+            )
+    return wrapper
+
+first_update_seen = False
+inflight_callbacks = {}  # (user_id, callback_data) -> задача, выполняющая этот запрос
+
+async def drop_duplicate_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Telegram повторно доставляет обновления при перезапуске polling и повторах webhook
+    keys = [f"update:{update.update_id}"]
+    if update.callback_query:
+        keys.append(f"callback:{update.callback_query.id}")
+    
+    if not all([seen_updates.check_and_mark(key) for key in keys]):
+        metrics.inc("updates_duplicate")
+        logger.info(
+            "Пропущено повторное обновление %s", update.update_id,
+            extra={"event": "duplicate_update", "update_id": update.update_id}
+        )
+        raise ApplicationHandlerStop
+
+async def run_coalesced(key, make_coroutine):
+    # Одинаковые одновременные запросы (двойное нажатие кнопки) ждут один общий результат
+    task = inflight_callbacks.get(key)
+    if task is None:
+        task = asyncio.ensure_future(make_coroutine())
+        inflight_callbacks[key] = task
+        task.add_done_callback(lambda _: inflight_callbacks.pop(key, None))
+    else:
+        metrics.inc("callbacks_coalesced")
+    return await asyncio.shield(task)
+
+async def track_first_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    global first_update_seen
+    if first_update_seen:
+        return
+    first_update_seen = True
+    latency = time.perf_counter() - PROCESS_STARTED_AT
+    metrics.observe("startup_first_update", latency)
+    logger.info(
+        "Первое обновление получено через %.2f с после запуска", latency,
+        extra={"event": "first_update", "latency_ms": round(latency * 1000, 1)}
+    )
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
-    logger.info(f"Новый пользователь: {user.id}")
+    logger.info("Новый пользователь: %s", user.id, extra={"user_id": user.id, "event": "start"})
     
     db.add_user(user)
     
@@ -511,20 +1598,38 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "Я бот для генерации WARP конфигураций. Выберите действие:",
         reply_markup=get_main_keyboard(user.id)
     )
+    
+    # /start <код> — переход по реферальной ссылке
+    if context.args:
+        error = xray_quota.redeem(user.id, context.args[0])
+        if error is None:
+            await update.message.reply_text(
+                f"🎁 Реферальный код активирован: +{REFERRAL_BONUS} запрос Xray VPN Veless."
+            )
+        else:
+            await update.message.reply_text(error)
 
 async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     
+    user = query.from_user
+    await run_coalesced((user.id, query.data), lambda: dispatch_callback(query, context))
+
+async def dispatch_callback(query, context: ContextTypes.DEFAULT_TYPE):
     user = query.from_user
     data = query.data
     
     if data == "get_config":
         await get_config(query, context)
+    elif data == "get_config_qr":
+        await get_config_qr(query, context)
+    elif data == "xray_request":
+        await xray_request(query, context)
     elif data == "help":
         await help_command(query, context)
     elif data == "stats" and is_admin(user.id):
-        await stats_command(query, context)
+        await send_stats(query.from_user, query.message)
     elif data == "users" and is_admin(user.id):
         await users_command(query, context)
 
@@ -537,8 +1642,13 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "Этот бот генерирует конфигурации для WARP.\n\n"
         "Основные команды:\n"
         "/start - Начать работу с ботом\n"
-        "/getconfig - Получить конфигурацию\n\n"
-        "Конфигурацию можно запрашивать раз в 24 часа."
+        "/getconfig - Получить конфигурацию\n"
+        "Кнопка «QR-код конфига» - конфигурация в виде QR-кода для WireGuard/AmneziaWG\n"
+        "/xray - Запросить доступ к Xray VPN Veless\n"
+        "/referral [код] - Ваш реферальный код или активация чужого\n\n"
+        f"Конфигурацию можно запрашивать раз в {CONFIG_COOLDOWN_HOURS} ч.\n"
+        f"Запросов Xray VPN Veless: {XRAY_DAILY_LIMIT} в день, "
+        f"+{REFERRAL_BONUS} за каждого приглашённого пользователя."
     )
     
     if is_admin(user.id):
@@ -548,7 +1658,8 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
             "/users - Список пользователей\n"
             "/ban <id> - Забанить пользователя\n"
             "/unban <id> - Разбанить пользователя\n"
-            "/broadcast <текст> - Сделать рассылку"
+            "/broadcast <текст> - Сделать рассылку\n"
+            "/reload - Перечитать настройки"
         )
     
     await query.edit_message_text(
@@ -556,18 +1667,27 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         reply_markup=get_main_keyboard(user.id)
     )
 
-async def get_config(query: Update, context: ContextTypes.DEFAULT_TYPE):
+# Общие проверки для выдачи конфигурации файлом и QR-кодом
+async def check_can_get_config(query):
     user = query.from_user
     
     if db.is_banned(user.id):
         await query.message.reply_text("❌ Вы забанены и не можете получать конфигурации.")
-        return
+        return False
     
     if not db.can_get_config(user.id):
         await query.message.reply_text(
-            "⏳ Вы можете запрашивать конфигурацию только раз в 24 часа. "
+            f"⏳ Вы можете запрашивать конфигурацию только раз в {CONFIG_COOLDOWN_HOURS} ч. "
             "Попробуйте позже."
         )
+        return False
+    
+    return True
+
+async def get_config(query: Update, context: ContextTypes.DEFAULT_TYPE):
+    user = query.from_user
+    
+    if not await check_can_get_config(query):
         return
     
     config = generate_warp_config()
@@ -587,22 +1707,129 @@ async def get_config(query: Update, context: ContextTypes.DEFAULT_TYPE):
     
     os.remove(config_file)
     
-    logger.info(f"Пользователь {user.id} получил конфигурацию")
+    logger.info("Пользователь %s получил конфигурацию", user.id, extra={"user_id": user.id, "event": "config_sent"})
 
-async def stats_command(query: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not is_admin(query.from_user.id):
-        await query.message.reply_text("❌ Эта команда только для администратора.")
+async def get_config_qr(query: Update, context: ContextTypes.DEFAULT_TYPE):
+    user = query.from_user
+    
+    if not await check_can_get_config(query):
         return
     
-    active_users, banned_users, active_configs, total_configs = db.get_stats()
+    config = generate_warp_config()
+    db.add_config(user.id)
     
-    response = (
-        "📊 Статистика бота:\n\n"
-        f"👥 Пользователи: {active_users} активных, {banned_users} забаненных\n"
-        f"📂 Конфигурации: {active_configs} активных, {total_configs} всего"
+    caption = "Отсканируйте QR-код в приложении WireGuard или AmneziaWG"
+    payload_hash = hashlib.sha256(config.encode('utf-8')).hexdigest()
+    
+    # Одинаковые конфиги не перерисовываем: Telegram позволяет переотправить фото по file_id
+    file_id = db.get_qr_file_id(payload_hash)
+    if file_id:
+        try:
+            await context.bot.send_photo(chat_id=user.id, photo=file_id, caption=caption)
+            metrics.inc("qr_cache_hit")
+            logger.info(
+                "Пользователь %s получил QR-код конфигурации (из кэша)", user.id,
+                extra={"user_id": user.id, "event": "config_qr_sent", "cached": True}
+            )
+            return
+        except BadRequest as e:
+            # Недействительный file_id; сетевые ошибки пробрасываем, не трогая кэш
+            logger.warning("file_id QR-кода устарел, отрисовываю заново: %s", e, extra={"user_id": user.id})
+            db.forget_qr_file_id(payload_hash)
+    
+    metrics.inc("qr_cache_miss")
+    png = await render_qr_png_async(config)
+    message = await context.bot.send_photo(
+        chat_id=user.id,
+        photo=png,
+        filename="warp.png",
+        caption=caption
     )
     
-    await query.message.reply_text(response)
+    if message.photo:
+        db.save_qr_file_id(payload_hash, message.photo[-1].file_id)
+    
+    logger.info(
+        "Пользователь %s получил QR-код конфигурации", user.id,
+        extra={"user_id": user.id, "event": "config_qr_sent", "cached": False}
+    )
+
+async def xray_request(query: Update, context: ContextTypes.DEFAULT_TYPE):
+    await process_xray_request(query.from_user, query.message)
+
+async def xray_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await process_xray_request(update.effective_user, update.message)
+
+async def process_xray_request(user, message):
+    if db.is_banned(user.id):
+        await message.reply_text("❌ Вы забанены и не можете отправлять запросы.")
+        return
+    
+    if not xray_quota.consume(user.id, "xray_request"):
+        await message.reply_text(
+            "⏳ Лимит запросов Xray VPN Veless на сегодня исчерпан. "
+            "Пригласите друзей через /referral, чтобы получить дополнительные запросы."
+        )
+        return
+    
+    enqueue_jobs([
+        (
+            "send_message",
+            {"chat_id": admin_id, "text": f"📝 Запрос Xray VPN Veless от пользователя {user.id} (@{user.username or 'N/A'})"},
+            None
+        )
+        for admin_id in ADMIN_IDS
+    ])
+    
+    await message.reply_text(
+        "✅ Запрос на доступ к Xray VPN Veless отправлен администратору.\n"
+        f"Осталось запросов: {xray_quota.remaining(user.id)}"
+    )
+    
+    logger.info("Пользователь %s запросил Xray VPN Veless", user.id, extra={"user_id": user.id, "event": "xray_request"})
+
+async def referral_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user = update.effective_user
+    db.add_user(user)
+    
+    if context.args:
+        error = xray_quota.redeem(user.id, context.args[0])
+        await update.message.reply_text(
+            error or f"🎁 Реферальный код активирован: +{REFERRAL_BONUS} запрос Xray VPN Veless."
+        )
+        return
+    
+    code = db.get_or_create_referral_code(user.id)
+    await update.message.reply_text(
+        f"🔗 Ваш реферальный код: {code}\n"
+        f"Друг может активировать его командой /referral {code} — "
+        f"вы оба получите +{REFERRAL_BONUS} запрос Xray VPN Veless.\n\n"
+        f"Доступно запросов сейчас: {xray_quota.remaining(user.id)}"
+    )
+
+async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await send_stats(update.effective_user, update.effective_message)
+
+async def send_stats(user, message):
+    if not is_admin(user.id):
+        await message.reply_text("❌ Эта команда только для администратора.")
+        return
+    
+    response = format_stats_text(stats_cache.get())
+    
+    job_counts = db.get_job_counts()
+    if job_counts:
+        response += (
+            "\n🗂 Очередь задач: "
+            f"{job_counts.get('pending', 0) + job_counts.get('running', 0)} в работе, "
+            f"{job_counts.get('done', 0)} выполнено, {job_counts.get('failed', 0)} с ошибкой"
+        )
+    
+    metrics_report = metrics.format_report()
+    if metrics_report:
+        response += f"\n\n⏱ Метрики:\n{metrics_report}"
+    
+    await message.reply_text(response)
 
 async def users_command(query: Update, context: ContextTypes.DEFAULT_TYPE):
     if not is_admin(query.from_user.id):
@@ -636,14 +1863,12 @@ async def ban_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         
         await update.message.reply_text(f"Пользователь {user_id} забанен.")
         
-        try:
-            await context.bot.send_message(
-                chat_id=user_id,
-                text="⛔ Вы были забанены администратором."
-            )
-        except Exception as e:
-            logger.warning(f"Не удалось уведомить пользователя {user_id}: {e}")
-            
+        enqueue_job(
+            "send_message",
+            {"chat_id": user_id, "text": "⛔ Вы были забанены администратором."},
+            f"ban:{user_id}:{update.update_id}"
+        )
+        
     except ValueError:
         await update.message.reply_text("Неверный ID пользователя.")
 
@@ -662,14 +1887,12 @@ async def unban_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         
         await update.message.reply_text(f"Пользователь {user_id} разбанен.")
         
-        try:
-            await context.bot.send_message(
-                chat_id=user_id,
-                text="✅ Вы были разбанены администратором."
-            )
-        except Exception as e:
-            logger.warning(f"Не удалось уведомить пользователя {user_id}: {e}")
-            
+        enqueue_job(
+            "send_message",
+            {"chat_id": user_id, "text": "✅ Вы были разбанены администратором."},
+            f"unban:{user_id}:{update.update_id}"
+        )
+        
     except ValueError:
         await update.message.reply_text("Неверный ID пользователя.")
 
@@ -689,39 +1912,26 @@ async def broadcast_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Нет активных пользователей для рассылки.")
         return
     
-    success = 0
-    failed = 0
-    
+    # Это сообщение отчёт о рассылке будет обновлять по мере отправки
     progress_msg = await update.message.reply_text(f"Начинаю рассылку для {len(users)} пользователей...")
     
-    for user_id in users:
-        try:
-            await context.bot.send_message(
-                chat_id=user_id,
-                text=f"📢 Сообщение от администратора:\n\n{message}"
-            )
-            success += 1
-        except Exception as e:
-            failed += 1
-            logger.warning(f"Не удалось отправить сообщение пользователю {user_id}: {e}")
-        
-        if (success + failed) % 10 == 0:
-            await progress_msg.edit_text(
-                f"Рассылка в процессе...\n"
-                f"✅ Успешно: {success}\n"
-                f"❌ Не удалось: {failed}"
-            )
-        
-        await asyncio.sleep(0.1)
-    
-    await progress_msg.edit_text(
-        f"Рассылка завершена:\n"
-        f"✅ Успешно: {success}\n"
-        f"❌ Не удалось: {failed}"
+    broadcast_id = str(uuid.uuid4())
+    enqueue_job(
+        "broadcast",
+        {
+            "broadcast_id": broadcast_id,
+            "message": message,
+            "report_chat_ids": [progress_msg.chat_id],
+            "report_message_id": progress_msg.message_id,
+        },
+        f"broadcast:{update.update_id}"
     )
 
 async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    logger.error(f"Ошибка: {context.error}", exc_info=context.error)
+    logger.error(
+        "Ошибка: %s", context.error, exc_info=context.error,
+        extra={"user_id": update.effective_user.id if isinstance(update, Update) and update.effective_user else None}
+    )
     
     if update and update.callback_query:
         try:
@@ -735,36 +1945,171 @@ async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         except:
             pass
 
-# Запуск Flask в отдельном потоке
-def run_flask():
-    app.run(host='0.0.0.0', port=5000, debug=False)
+# Горячая перезагрузка настроек: лимиты, шаблоны и список администраторов
+def warn_if_dashboard_locked(values):
+    if not settings.has_admin_password(values):
+        logger.warning(
+            "Не задан ADMIN_PASSWORD или ADMIN_PASSWORD_HASH: вход в веб-интерфейс закрыт",
+            extra={"event": "admin_password_missing"}
+        )
+
+def reload_settings():
+    global ADMIN_IDS, ADMIN_USERNAME, ADMIN_PASSWORD, ADMIN_PASSWORD_HASH
+    global CONFIG_COOLDOWN_HOURS, XRAY_DAILY_LIMIT, REFERRAL_BONUS, WARP_CONFIG, TEMPLATES
+    try:
+        values = settings.load_settings()
+        templates = load_templates(values["TEMPLATES_DIR"])
+        warp_config = load_warp_config(values["WARP_CONFIG_FILE"])
+    except Exception as e:
+        # Ошибка в .env или файле шаблона не должна ронять работающего бота
+        logger.error("Не удалось перечитать настройки: %s", e, exc_info=e, extra={"event": "settings_reload_failed"})
+        return False
+    
+    ADMIN_IDS = set(values["ADMIN_IDS"])
+    ADMIN_USERNAME = values["ADMIN_USERNAME"]
+    ADMIN_PASSWORD = values["ADMIN_PASSWORD"]
+    ADMIN_PASSWORD_HASH = values["ADMIN_PASSWORD_HASH"]
+    get_admin_password_hash.cache_clear()
+    warn_if_dashboard_locked(values)
+    
+    CONFIG_COOLDOWN_HOURS = values["CONFIG_COOLDOWN_HOURS"]
+    XRAY_DAILY_LIMIT = values["XRAY_DAILY_LIMIT"]
+    REFERRAL_BONUS = values["REFERRAL_BONUS"]
+    xray_quota.daily_limit = XRAY_DAILY_LIMIT
+    xray_quota.referral_bonus = REFERRAL_BONUS
+    
+    WARP_CONFIG = warp_config
+    # Новый загрузчик подменяется целиком, чтобы параллельный рендер не увидел пустой или частичный словарь
+    TEMPLATES = templates
+    if app is not None:
+        from jinja2 import DictLoader
+        app.jinja_loader = DictLoader(templates)
+        if app.jinja_env.cache is not None:
+            app.jinja_env.cache.clear()
+    
+    logger.info(
+        "Настройки перечитаны", extra={
+            "event": "settings_reloaded",
+            "admins": len(ADMIN_IDS),
+            "config_cooldown_hours": CONFIG_COOLDOWN_HOURS,
+            "xray_daily_limit": XRAY_DAILY_LIMIT,
+        }
+    )
+    return True
+
+async def reload_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_admin(update.effective_user.id):
+        await update.message.reply_text("❌ Эта команда только для администратора.")
+        return
+    
+    if reload_settings():
+        await update.message.reply_text("✅ Настройки перечитаны.")
+    else:
+        await update.message.reply_text("❌ Не удалось перечитать настройки, подробности в логе.")
+
+# Считает запросы, которые сейчас обрабатывает Flask. Простаивающие соединения сюда не попадают,
+# поэтому потоки werkzeug остаются daemon и не мешают процессу завершиться
+class InflightRequests:
+    def __init__(self, wsgi_app):
+        from werkzeug.wsgi import ClosingIterator
+        
+        self.wsgi_app = wsgi_app
+        self.closing_iterator = ClosingIterator
+        self.count = 0
+        self.condition = threading.Condition()
+    
+    def __call__(self, environ, start_response):
+        with self.condition:
+            self.count += 1
+        try:
+            response = self.wsgi_app(environ, start_response)
+        except BaseException:
+            self.finished()
+            raise
+        # Ответ (в том числе поток SSE) считается завершённым, когда сервер закроет итератор
+        return self.closing_iterator(response, self.finished)
+    
+    def finished(self):
+        with self.condition:
+            self.count -= 1
+            self.condition.notify_all()
+    
+    def wait_idle(self, timeout):
+        with self.condition:
+            return self.condition.wait_for(lambda: self.count == 0, timeout)
+
+# Веб-интерфейс в отдельном потоке; при остановке дожидаемся текущих запросов
+web_requests = None
+
+def start_web_server():
+    global app, web_server, web_thread, web_requests
+    from werkzeug.serving import make_server
+    
+    app = create_app()
+    web_requests = InflightRequests(app.wsgi_app)
+    app.wsgi_app = web_requests
+    web_server = make_server('0.0.0.0', WEB_PORT, app, threaded=True)
+    web_thread = threading.Thread(target=web_server.serve_forever, name="flask")
+    web_thread.start()
+
+def stop_web_server():
+    if web_server is None:
+        return
+    shutdown_event.set()
+    web_server.shutdown()
+    web_thread.join(timeout=WEB_SHUTDOWN_TIMEOUT)
+    if not web_requests.wait_idle(WEB_SHUTDOWN_TIMEOUT):
+        logger.warning(
+            "Веб-интерфейс: %d запросов не завершились за %d с", web_requests.count, WEB_SHUTDOWN_TIMEOUT,
+            extra={"event": "web_shutdown_timeout"}
+        )
+    web_server.server_close()
 
 # Основная функция
 def main():
     global application
-    # Запуск Telegram-бота
-    application = Application.builder().token(BOT_TOKEN).build()
+    missing = settings.missing_required(SETTINGS)
+    if missing:
+        logger.error(
+            "Не заданы обязательные настройки: %s (.env или переменные окружения)", ", ".join(missing),
+            extra={"event": "settings_missing", "missing": missing}
+        )
+        sys.exit(1)
+    warn_if_dashboard_locked(SETTINGS)
     
-    # Запуск Flask в отдельном потоке
-    flask_thread = threading.Thread(target=run_flask)
-    flask_thread.daemon = True
-    flask_thread.start()
+    # Запуск Telegram-бота
+    application = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .concurrent_updates(CONCURRENT_UPDATES)
+        .post_init(post_init)
+        .post_stop(post_stop)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
     
-    application.add_handler(CommandHandler("start", start))
-    application.add_handler(CommandHandler("help", help_command))
-    application.add_handler(CommandHandler("getconfig", get_config))
+    application.add_handler(TypeHandler(Update, drop_duplicate_update), group=-2)
+    application.add_handler(TypeHandler(Update, track_first_update), group=-1)
+    application.add_handler(CommandHandler("start", timed_handler(start)))
+    application.add_handler(CommandHandler("help", timed_handler(help_command)))
+    application.add_handler(CommandHandler("getconfig", timed_handler(get_config)))
+    application.add_handler(CommandHandler("xray", timed_handler(xray_command)))
+    application.add_handler(CommandHandler("referral", timed_handler(referral_command)))
     
-    application.add_handler(CommandHandler("stats", stats_command))
-    application.add_handler(CommandHandler("users", users_command))
-    application.add_handler(CommandHandler("ban", ban_command))
-    application.add_handler(CommandHandler("unban", unban_command))
-    application.add_handler(CommandHandler("broadcast", broadcast_command))
+    application.add_handler(CommandHandler("stats", timed_handler(stats_command)))
+    application.add_handler(CommandHandler("users", timed_handler(users_command)))
+    application.add_handler(CommandHandler("ban", timed_handler(ban_command)))
+    application.add_handler(CommandHandler("unban", timed_handler(unban_command)))
+    application.add_handler(CommandHandler("broadcast", timed_handler(broadcast_command)))
+    application.add_handler(CommandHandler("reload", timed_handler(reload_command)))
     
-    application.add_handler(CallbackQueryHandler(button_handler))
+    application.add_handler(CallbackQueryHandler(timed_handler(button_handler)))
     
     application.add_error_handler(error_handler)
     
     application.run_polling()
 
+metrics.observe("startup_import", time.perf_counter() - PROCESS_STARTED_AT)
+
 if __name__ == "__main__":
     main()
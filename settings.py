@@ -1,7 +1,75 @@
-from dotenv import load_dotenv
+from dotenv import dotenv_values
 import os
 
-load_dotenv()
+# .env ищется рядом с settings.py, а не в текущей папке процесса
+ENV_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".env")
 
-TOKEN = os.getenv("TOKEN")
-ADMIN_ID = int(os.getenv("ADMIN_ID"))
+# Старые имена переменных из прежней версии settings.py
+LEGACY_NAMES = {
+    "TOKEN": "BOT_TOKEN",
+    "ADMIN_ID": "ADMIN_TELEGRAM_ID",
+}
+
+DEFAULTS = {
+    "BOT_TOKEN": "",
+    "ADMIN_TELEGRAM_ID": "650154766",
+    "DB_FILE": "warp_bot.db",
+    "PORT": "5000",
+    "WEB_SECRET_KEY": "",
+    "ADMIN_USERNAME": "astracat",
+    "ADMIN_PASSWORD": "",
+    "ADMIN_PASSWORD_HASH": "",
+    "CONFIG_COOLDOWN_HOURS": "24",
+    "XRAY_DAILY_LIMIT": "1",
+    "REFERRAL_BONUS": "1",
+    "TEMPLATES_DIR": "",
+    "WARP_CONFIG_FILE": "",
+}
+
+def parse_id_list(value):
+    return [int(item) for item in value.replace(";", ",").split(",") if item.strip()]
+
+def load_settings(env_file=None):
+    # Переменные окружения важнее .env; файл перечитывается при каждом вызове (для перезагрузки по SIGHUP)
+    known = set(DEFAULTS) | set(LEGACY_NAMES)
+    overrides = {key: value for key, value in dotenv_values(env_file or ENV_FILE).items() if key in known and value}
+    overrides.update({key: value for key, value in os.environ.items() if key in known and value})
+
+    # Старое имя используется, только если новое не задано ни в .env, ни в окружении
+    for legacy_name, name in LEGACY_NAMES.items():
+        if legacy_name in overrides and name not in overrides:
+            overrides[name] = overrides[legacy_name]
+
+    raw = dict(DEFAULTS)
+    raw.update({key: value for key, value in overrides.items() if key in DEFAULTS})
+
+    return {
+        "BOT_TOKEN": raw["BOT_TOKEN"],
+        # Можно указать несколько администраторов через запятую
+        "ADMIN_IDS": parse_id_list(raw["ADMIN_TELEGRAM_ID"]),
+        "DB_FILE": raw["DB_FILE"],
+        "PORT": int(raw["PORT"]),
+        "WEB_SECRET_KEY": raw["WEB_SECRET_KEY"] or None,
+        "ADMIN_USERNAME": raw["ADMIN_USERNAME"],
+        "ADMIN_PASSWORD": raw["ADMIN_PASSWORD"],
+        "ADMIN_PASSWORD_HASH": raw["ADMIN_PASSWORD_HASH"] or None,
+        "CONFIG_COOLDOWN_HOURS": int(raw["CONFIG_COOLDOWN_HOURS"]),
+        "XRAY_DAILY_LIMIT": int(raw["XRAY_DAILY_LIMIT"]),
+        "REFERRAL_BONUS": int(raw["REFERRAL_BONUS"]),
+        "TEMPLATES_DIR": raw["TEMPLATES_DIR"] or None,
+        "WARP_CONFIG_FILE": raw["WARP_CONFIG_FILE"] or None,
+    }
+
+def missing_required(values):
+    # Без токена бот не запустится; без пароля работает всё, кроме входа в веб-интерфейс
+    missing = []
+    if not values["BOT_TOKEN"]:
+        missing.append("BOT_TOKEN")
+    return missing
+
+def has_admin_password(values):
+    return bool(values["ADMIN_PASSWORD"] or values["ADMIN_PASSWORD_HASH"])
+
+SETTINGS = load_settings()
+TOKEN = SETTINGS["BOT_TOKEN"]
+ADMIN_ID = SETTINGS["ADMIN_IDS"][0] if SETTINGS["ADMIN_IDS"] else None
@@ -0,0 +1,19 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+# bot.py открывает базу при импорте, поэтому направляем её во временную папку заранее
+os.environ.setdefault("DB_FILE", os.path.join(tempfile.mkdtemp(prefix="warp_bot_tests_"), "warp_bot.db"))
+
+@pytest.fixture
+def database(tmp_path):
+    import bot
+
+    database = bot.Database(str(tmp_path / "warp_bot.db"))
+    yield database
+    database.conn.close()
@@ -0,0 +1,154 @@
+import asyncio
+
+import pytest
+
+import bot
+
+def test_claim_marks_job_running(database):
+    database.enqueue_jobs([("send_message", {"chat_id": 1, "text": "hi"}, None)])
+
+    job_id, kind, payload, attempts = database.claim_job("w1", 60)
+
+    assert (kind, payload, attempts) == ("send_message", {"chat_id": 1, "text": "hi"}, 1)
+    assert database.get_job_counts() == {"running": 1}
+    # Пока не истёк visibility timeout, задачу не получит другой воркер
+    assert database.claim_job("w2", 60) is None
+
+def test_claim_returns_none_for_empty_queue(database):
+    assert database.claim_job("w1", 60) is None
+
+def test_idempotency_key_deduplicates(database):
+    job = ("broadcast", {"broadcast_id": "b1", "message": "hi"}, "broadcast:b1")
+
+    assert database.enqueue_jobs([job]) == 1
+    assert database.enqueue_jobs([job]) == 0
+    assert database.get_job_counts() == {"pending": 1}
+
+def test_jobs_without_key_are_not_deduplicated(database):
+    job = ("send_message", {"chat_id": 1, "text": "hi"}, None)
+
+    database.enqueue_jobs([job, job])
+
+    assert database.get_job_counts() == {"pending": 2}
+
+def test_expired_visibility_timeout_allows_reclaim(database):
+    database.enqueue_jobs([("send_message", {"chat_id": 1, "text": "hi"}, None)])
+    job_id = database.claim_job("crashed", 0)[0]
+
+    reclaimed = database.claim_job("w2", 60)
+
+    assert reclaimed[0] == job_id
+    assert reclaimed[3] == 2
+
+def test_retry_delays_job_until_run_at(database):
+    database.enqueue_jobs([("send_message", {"chat_id": 1, "text": "hi"}, None)])
+    job_id = database.claim_job("w1", 60)[0]
+
+    database.retry_job(job_id, 60, "timeout")
+    assert database.claim_job("w1", 60) is None
+
+    database.retry_job(job_id, 0, "timeout")
+    assert database.claim_job("w1", 60)[0] == job_id
+
+def test_complete_and_fail_are_final(database):
+    database.enqueue_jobs([
+        ("send_message", {"chat_id": 1, "text": "hi"}, None),
+        ("send_message", {"chat_id": 2, "text": "hi"}, None),
+    ])
+    database.complete_job(database.claim_job("w1", 0)[0])
+    database.fail_job(database.claim_job("w1", 0)[0], "blocked")
+
+    assert database.claim_job("w1", 60) is None
+    assert database.get_job_counts() == {"done": 1, "failed": 1}
+
+def test_release_jobs_returns_only_own_jobs(database):
+    database.enqueue_jobs([
+        ("send_message", {"chat_id": 1, "text": "hi"}, None),
+        ("send_message", {"chat_id": 2, "text": "hi"}, None),
+    ])
+    own_id = database.claim_job("w1", 60)[0]
+    database.claim_job("other", 60)
+
+    assert database.release_jobs(["w1"]) == 1
+
+    job_id, _, _, attempts = database.claim_job("w2", 60)
+    assert job_id == own_id
+    # Прерванная остановкой попытка не засчитывается
+    assert attempts == 1
+
+def test_retry_delay_grows_exponentially():
+    assert [bot.job_retry_delay(n) for n in (1, 2, 3)] == [
+        bot.JOB_RETRY_BASE_DELAY,
+        bot.JOB_RETRY_BASE_DELAY * 2,
+        bot.JOB_RETRY_BASE_DELAY * 4,
+    ]
+
+def test_run_job_retries_then_fails(database, monkeypatch):
+    monkeypatch.setattr(bot, "db", database)
+    monkeypatch.setattr(bot, "JOB_RETRY_BASE_DELAY", 0)
+    monkeypatch.setattr(bot, "JOB_SEND_DELAY", 0)
+
+    class FailingBot:
+        calls = 0
+
+        async def send_message(self, chat_id, text):
+            self.calls += 1
+            raise RuntimeError("network down")
+
+    failing_bot = FailingBot()
+    database.enqueue_jobs([("send_message", {"chat_id": 1, "text": "hi"}, None)])
+
+    for _ in range(bot.JOB_MAX_ATTEMPTS):
+        assert asyncio.run(bot.run_job(failing_bot, "w1"))
+
+    assert failing_bot.calls == bot.JOB_MAX_ATTEMPTS
+    assert database.get_job_counts() == {"failed": 1}
+    assert not asyncio.run(bot.run_job(failing_bot, "w1"))
+
+def test_broadcast_jobs_yield_to_default_priority(database):
+    database.enqueue_jobs(
+        [("send_message", {"chat_id": n, "text": "news"}, None) for n in range(3)],
+        priority=bot.JOB_PRIORITY_BROADCAST,
+        batch_id="b1"
+    )
+    database.enqueue_jobs([("send_message", {"chat_id": 99, "text": "banned"}, None)])
+
+    _, _, payload, _ = database.claim_job("w1", 60)
+
+    assert payload["chat_id"] == 99
+
+def test_postpone_does_not_count_attempt(database):
+    database.enqueue_jobs([("broadcast_report", {"broadcast_id": "b1"}, None)])
+    job_id = database.claim_job("w1", 60)[0]
+
+    database.postpone_job(job_id, 0)
+
+    assert database.claim_job("w1", 60)[3] == 1
+
+def test_broadcast_report_waits_for_batch(database, monkeypatch):
+    monkeypatch.setattr(bot, "db", database)
+    monkeypatch.setattr(bot, "JOB_SEND_DELAY", 0)
+
+    class RecordingBot:
+        def __init__(self):
+            self.sent = []
+
+        async def send_message(self, chat_id, text):
+            self.sent.append((chat_id, text))
+
+    recording_bot = RecordingBot()
+    database.enqueue_jobs(
+        [("send_message", {"chat_id": n, "text": "news"}, None) for n in (1, 2)],
+        priority=bot.JOB_PRIORITY_BROADCAST,
+        batch_id="b1"
+    )
+    payload = {"broadcast_id": "b1", "chat_ids": [42], "message_id": None}
+
+    with pytest.raises(bot.JobNotReady):
+        asyncio.run(bot.job_broadcast_report(recording_bot, payload))
+
+    database.complete_job(database.claim_job("w1", 60)[0])
+    database.fail_job(database.claim_job("w1", 60)[0], "blocked")
+    asyncio.run(bot.job_broadcast_report(recording_bot, payload))
+
+    assert recording_bot.sent == [(42, "Рассылка завершена:\n✅ Успешно: 1\n❌ Не удалось: 1")]
@@ -0,0 +1,79 @@
+import asyncio
+import time
+
+import bot
+
+def test_check_and_mark_rejects_repeat(database):
+    seen = bot.SeenUpdates(database, ttl=60, max_size=10, prune_every=100)
+
+    assert seen.check_and_mark("update:1")
+    assert not seen.check_and_mark("update:1")
+    assert seen.check_and_mark("update:2")
+
+def test_check_and_mark_falls_back_to_database(database):
+    # Ключ вытеснен из памяти (или бот перезапущен), но остался в таблице
+    seen = bot.SeenUpdates(database, ttl=60, max_size=1, prune_every=100)
+    seen.check_and_mark("update:1")
+    seen.check_and_mark("update:2")
+
+    assert "update:1" not in seen.recent
+    assert not seen.check_and_mark("update:1")
+
+    restarted = bot.SeenUpdates(database, ttl=60, max_size=10, prune_every=100)
+    assert not restarted.check_and_mark("update:2")
+
+def test_memory_cache_is_bounded(database):
+    seen = bot.SeenUpdates(database, ttl=60, max_size=3, prune_every=100)
+
+    for n in range(10):
+        seen.check_and_mark(f"update:{n}")
+
+    assert list(seen.recent) == ["update:7", "update:8", "update:9"]
+
+def test_expired_keys_are_pruned(database):
+    seen = bot.SeenUpdates(database, ttl=0, max_size=10, prune_every=2)
+    seen.check_and_mark("update:1")
+    time.sleep(0.01)
+
+    # Вторая вставка запускает очистку, после чего первый ключ снова считается новым
+    seen.check_and_mark("update:2")
+
+    assert database.mark_update_seen("update:1")
+
+def test_run_coalesced_shares_one_result(monkeypatch):
+    monkeypatch.setattr(bot, "inflight_callbacks", {})
+    calls = []
+
+    async def fetch():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return "config"
+
+    async def press_twice():
+        return await asyncio.gather(
+            bot.run_coalesced((1, "get_config"), fetch),
+            bot.run_coalesced((1, "get_config"), fetch),
+        )
+
+    assert asyncio.run(press_twice()) == ["config", "config"]
+    assert len(calls) == 1
+    assert bot.inflight_callbacks == {}
+
+def test_run_coalesced_keeps_distinct_keys_apart(monkeypatch):
+    monkeypatch.setattr(bot, "inflight_callbacks", {})
+    calls = []
+
+    async def fetch():
+        calls.append(1)
+        await asyncio.sleep(0)
+        return len(calls)
+
+    async def press_both():
+        return await asyncio.gather(
+            bot.run_coalesced((1, "get_config"), fetch),
+            bot.run_coalesced((2, "get_config"), fetch),
+        )
+
+    asyncio.run(press_both())
+
+    assert len(calls) == 2
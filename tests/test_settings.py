@@ -0,0 +1,103 @@
+import os
+
+import pytest
+
+import bot
+import settings
+
+@pytest.fixture
+def env_file(tmp_path, monkeypatch):
+    # Чистое окружение: значения берутся только из временного .env
+    for name in list(settings.DEFAULTS) + list(settings.LEGACY_NAMES):
+        monkeypatch.delenv(name, raising=False)
+    path = tmp_path / ".env"
+    path.write_text("")
+    monkeypatch.setattr(settings, "ENV_FILE", str(path))
+    return path
+
+def test_defaults_without_env_file(env_file):
+    values = settings.load_settings()
+
+    assert values["BOT_TOKEN"] == ""
+    assert values["WEB_SECRET_KEY"] is None
+    assert values["PORT"] == 5000
+    assert settings.missing_required(values) == ["BOT_TOKEN"]
+    assert not settings.has_admin_password(values)
+
+def test_env_file_is_next_to_settings_module():
+    assert settings.ENV_FILE.endswith(".env")
+    assert settings.ENV_FILE.startswith(os.path.dirname(settings.__file__))
+
+def test_legacy_names_in_env_file(env_file):
+    env_file.write_text("TOKEN=legacy-token\nADMIN_ID=1, 2\n")
+
+    values = settings.load_settings()
+
+    assert values["BOT_TOKEN"] == "legacy-token"
+    assert values["ADMIN_IDS"] == [1, 2]
+    assert settings.missing_required(values) == []
+
+def test_new_name_wins_over_legacy(env_file, monkeypatch):
+    env_file.write_text("BOT_TOKEN=new-token\n")
+    monkeypatch.setenv("TOKEN", "legacy-token")
+
+    assert settings.load_settings()["BOT_TOKEN"] == "new-token"
+
+def test_environment_wins_over_env_file(env_file, monkeypatch):
+    env_file.write_text("BOT_TOKEN=file-token\nXRAY_DAILY_LIMIT=3\nADMIN_PASSWORD=secret\n")
+    monkeypatch.setenv("BOT_TOKEN", "env-token")
+    # Пустая переменная окружения не затирает значение из .env
+    monkeypatch.setenv("XRAY_DAILY_LIMIT", "")
+
+    values = settings.load_settings()
+
+    assert values["BOT_TOKEN"] == "env-token"
+    assert values["XRAY_DAILY_LIMIT"] == 3
+    assert settings.has_admin_password(values)
+
+@pytest.fixture
+def reloadable(env_file, monkeypatch):
+    # Возвращаем глобальные настройки bot.py после теста
+    for name in (
+        "ADMIN_IDS", "ADMIN_USERNAME", "ADMIN_PASSWORD", "ADMIN_PASSWORD_HASH",
+        "CONFIG_COOLDOWN_HOURS", "XRAY_DAILY_LIMIT", "REFERRAL_BONUS", "WARP_CONFIG", "TEMPLATES", "app",
+    ):
+        monkeypatch.setattr(bot, name, getattr(bot, name))
+    monkeypatch.setattr(bot.xray_quota, "daily_limit", bot.xray_quota.daily_limit)
+    monkeypatch.setattr(bot.xray_quota, "referral_bonus", bot.xray_quota.referral_bonus)
+    bot.get_admin_password_hash.cache_clear()
+    yield env_file
+    bot.get_admin_password_hash.cache_clear()
+
+def test_reload_applies_new_values_and_templates(reloadable, tmp_path):
+    templates_dir = tmp_path / "templates"
+    templates_dir.mkdir()
+    (templates_dir / "login.html").write_text("custom login", encoding="utf-8")
+    reloadable.write_text(f"ADMIN_TELEGRAM_ID=7\nXRAY_DAILY_LIMIT=5\nTEMPLATES_DIR={templates_dir}\n")
+    bot.app = bot.create_app()
+    client = bot.app.test_client()
+    assert client.get('/login').data != b"custom login"
+
+    assert bot.reload_settings()
+
+    assert bot.ADMIN_IDS == {7}
+    assert bot.xray_quota.daily_limit == 5
+    assert client.get('/login').data == b"custom login"
+
+def test_reload_without_password_keeps_dashboard_locked(reloadable):
+    reloadable.write_text("ADMIN_USERNAME=admin\n")
+
+    assert bot.reload_settings()
+
+    assert bot.get_admin_password_hash() is None
+    client = bot.create_app().test_client()
+    client.post('/login', data={"username": "admin", "password": ""})
+    assert client.get('/api/stats').status_code == 401
+
+def test_reload_keeps_old_values_on_error(reloadable):
+    reloadable.write_text("XRAY_DAILY_LIMIT=many\n")
+    daily_limit = bot.XRAY_DAILY_LIMIT
+
+    assert not bot.reload_settings()
+
+    assert bot.XRAY_DAILY_LIMIT == daily_limit
@@ -0,0 +1,39 @@
+from types import SimpleNamespace
+
+import pytest
+
+import bot
+
+@pytest.fixture
+def client(database, monkeypatch):
+    monkeypatch.setattr(bot, "db", database)
+    monkeypatch.setattr(bot, "stats_cache", bot.StatsCache(database))
+
+    client = bot.create_app().test_client()
+    with client.session_transaction() as session:
+        session['logged_in'] = True
+    return client
+
+def test_stats_requires_login(database, monkeypatch):
+    monkeypatch.setattr(bot, "db", database)
+
+    response = bot.create_app().test_client().get('/api/stats')
+
+    assert response.status_code == 401
+
+def test_stats_revalidates_with_etag(client, database):
+    first = client.get('/api/stats')
+    assert first.status_code == 200
+    assert first.json["stats"]["active_users"] == 0
+    etag = first.headers["ETag"]
+
+    cached = client.get('/api/stats', headers={"If-None-Match": etag})
+    assert cached.status_code == 304
+    assert cached.data == b""
+
+    database.add_user(SimpleNamespace(id=1, username="user", first_name="User", last_name=None))
+
+    changed = client.get('/api/stats', headers={"If-None-Match": etag})
+    assert changed.status_code == 200
+    assert changed.headers["ETag"] != etag
+    assert changed.json["stats"]["active_users"] == 1
@@ -0,0 +1,87 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import bot
+
+def make_quota(database, daily_limit=1, referral_bonus=1, max_size=100):
+    return bot.XrayQuota(database, daily_limit, referral_bonus, max_size)
+
+def test_consume_spends_daily_limit_then_bonus(database):
+    quota = make_quota(database, daily_limit=2)
+    database.add_quota_entry(1, 'bonus', 1, None, "test")
+
+    assert quota.remaining(1) == 3
+    assert [quota.consume(1, "xray") for _ in range(4)] == [True, True, True, False]
+    assert quota.remaining(1) == 0
+
+def test_remaining_survives_restart(database):
+    make_quota(database).consume(1, "xray")
+
+    # Новый экземпляр (перезапуск бота) восстанавливает баланс из журнала
+    assert make_quota(database).remaining(1) == 0
+    assert make_quota(database).remaining(2) == 1
+
+def test_new_day_resets_daily_limit(database, monkeypatch):
+    quota = make_quota(database)
+    quota.consume(1, "xray")
+    assert quota.remaining(1) == 0
+
+    class Tomorrow(bot.date):
+        @classmethod
+        def today(cls):
+            return bot.date(2100, 1, 1)
+
+    monkeypatch.setattr(bot, "date", Tomorrow)
+
+    assert quota.remaining(1) == 1
+    assert list(quota.balances) == [1]
+
+def test_balances_are_bounded(database):
+    quota = make_quota(database, max_size=3)
+
+    for user_id in range(10):
+        quota.remaining(user_id)
+
+    assert list(quota.balances) == [7, 8, 9]
+
+def test_redeem_rejects_unknown_and_own_code(database):
+    quota = make_quota(database)
+    code = database.get_or_create_referral_code(1)
+
+    assert quota.redeem(2, "nope") == "❌ Реферальный код не найден."
+    assert quota.redeem(1, code) == "❌ Нельзя активировать собственный реферальный код."
+
+def test_redeem_grants_bonus_to_both_users(database):
+    quota = make_quota(database, referral_bonus=2)
+    code = database.get_or_create_referral_code(1)
+    quota.remaining(1)
+
+    assert quota.redeem(2, f" :{code.upper()} ") is None
+    assert quota.redeem(2, code) == "❌ Вы уже активировали реферальный код."
+
+    assert quota.remaining(1) == 3
+    assert quota.remaining(2) == 3
+
+def test_concurrent_redemptions(database):
+    quota = make_quota(database)
+    code = database.get_or_create_referral_code(1)
+    quota.remaining(1)
+    # Пользователь 2 нажимает дважды, пользователь 3 — один раз, всё одновременно
+    redeemers = [2, 2, 3]
+    barrier = threading.Barrier(len(redeemers))
+
+    def redeem(user_id):
+        barrier.wait()
+        return quota.redeem(user_id, code)
+
+    with ThreadPoolExecutor(len(redeemers)) as executor:
+        results = list(executor.map(redeem, redeemers))
+
+    assert results[:2].count(None) == 1
+    assert "❌ Вы уже активировали реферальный код." in results[:2]
+    assert results[2] is None
+    assert quota.remaining(1) == 1 + 2
+    assert quota.remaining(2) == 1 + 1
+    assert quota.remaining(3) == 1 + 1
+    # Кэш и журнал в базе согласованы
+    assert make_quota(database).remaining(1) == 3